@@ -9,15 +9,18 @@ import os
 # - session: Para armazenar informações do usuário entre requisições (login).
 # - redirect, url_for: Para redirecionar o usuário para outras páginas.
 # - flash: Para exibir mensagens temporárias para o usuário.
-from flask import Flask, render_template, request, make_response, session, redirect, url_for, flash, jsonify, Response
+from flask import Flask, Blueprint, render_template, request, make_response, session, redirect, url_for, flash, jsonify, Response, g, current_app
 # flask_sock: Biblioteca para adicionar suporte a WebSocket ao Flask.
 from flask_sock import Sock
-# psycopg2: O "driver" que permite que o Python se conecte a um banco de dados PostgreSQL.
-import psycopg2
-# pandas: Uma biblioteca poderosa para manipulação e análise de dados. Usamos para criar o arquivo Excel.
-import pandas as pd
-# datetime, time, timedelta: Módulos padrão do Python para trabalhar com datas e horas.
-from datetime import datetime, time, timedelta
+# click: Biblioteca de linha de comando que já vem com o Flask (usada nos comandos 'flask ...').
+import click
+from flask.cli import with_appcontext
+# itsdangerous: Assinatura de dados (já vem com o Flask), usada nos links pessoais dos funcionários.
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+# datetime, date, time, timedelta: Módulos padrão do Python para trabalhar com datas e horas.
+from datetime import datetime, date, time, timedelta
+# array: Vetores compactos de números, usados no índice de calendário.
+from array import array
 # BytesIO: Permite tratar dados em memória (como um arquivo Excel) como se fosse um arquivo em disco.
 from io import BytesIO
 # groupby: Uma ferramenta útil para agrupar elementos de uma lista (usada para agrupar registros por funcionário/dia).
@@ -26,29 +29,241 @@ from itertools import groupby
 from functools import lru_cache
 # json: Biblioteca para manipular dados no formato JSON.
 import json
-# requests: Para fazer requisições HTTP para as APIs de feriados.
-import requests
-
-# --- Configuração Inicial do Aplicativo Flask ---
-# Cria a instância principal do nosso aplicativo web.
-app = Flask(__name__)
-# Inicializa o Flask-Sock para adicionar suporte a WebSockets ao aplicativo.
-sock = Sock(app)
-# Define uma "chave secreta" que o Flask usa para proteger as sessões dos usuários.
-# É importante que seja um valor longo, aleatório и secreto em um ambiente de produção.
-app.secret_key = 'sua_senha_super_secreta_aqui' # Troque por uma senha mais forte
+# zipfile: Para montar o arquivo ZIP com os espelhos de ponto.
+import zipfile
+# base64, gzip, hashlib: Usados no arquivamento das imagens dos access_logs.
+import base64
+import gzip
+import hashlib
+# sys, re, threading, random, perf_counter, deque: Usados na instrumentação das consultas SQL.
+import sys
+import re
+import threading
+import random
+from time import perf_counter, sleep, monotonic
+from collections import deque, Counter, namedtuple
+
+# Importações "preguiçosas" (lazy): bibliotecas pesadas como psycopg2, requests e
+# pandas (que carrega o numpy) só são importadas dentro das funções que as usam.
+# Isso deixa o "cold start" na Vercel muito mais rápido, já que a maioria das
+# requisições nunca precisa delas.
+
+# --- Registro de Rotas ---
+# As rotas ficam no Blueprint 'ponto' e são registradas de fato em create_app().
+# Assim as funções continuam sendo funções Python comuns (fáceis de testar) e nenhum
+# aplicativo é criado enquanto o módulo é importado. As rotas WebSocket (Flask-Sock)
+# também são registradas no Blueprint, com sock.route(..., bp=rotas).
+# Os endpoints têm o prefixo do Blueprint: url_for('ponto.index').
+rotas = Blueprint('ponto', __name__)
+sock = Sock()
 
 # --- Conexão com o Banco de Dados ---
 # Pega a URL de conexão do banco de dados a partir das "variáveis de ambiente" do sistema.
 # Em ambientes como o Render ou Heroku, esta variável é configurada no painel de controle.
 DATABASE_URL = os.environ.get('DATABASE_URL')
+# Modo SSL da conexão. Em um Postgres local (ex: testes de carga) use DATABASE_SSLMODE=disable.
+DATABASE_SSLMODE = os.environ.get('DATABASE_SSLMODE', 'require')
 
 def get_db_connection():
     """Cria e retorna uma nova conexão com o banco de dados PostgreSQL."""
-    # A opção sslmode='require' é frequentemente necessária para conexões seguras em serviços de nuvem.
-    conn = psycopg2.connect(DATABASE_URL, sslmode='require')
+    # psycopg2: O "driver" que permite que o Python se conecte a um banco de dados PostgreSQL.
+    import psycopg2
+    # A opção sslmode='require' (padrão) é frequentemente necessária para conexões seguras em serviços de nuvem.
+    # O cursor_factory faz todo cursor desta conexão medir o tempo de cada comando SQL.
+    conn = psycopg2.connect(DATABASE_URL, sslmode=DATABASE_SSLMODE, cursor_factory=classe_cursor_instrumentado())
     return conn
 
+# --- Instrumentação de Consultas SQL (Log de Consultas Lentas) ---
+# Todo comando executado pelas conexões de get_db_connection() tem sua duração medida
+# e agrupada pelo local da chamada (função:linha do app.py). Comandos acima do limite
+# são impressos no log e, por amostragem, têm o plano de execução (EXPLAIN) capturado.
+# As estatísticas ficam na memória de cada processo (worker) e são exibidas em /admin/consultas.
+
+# Duração (em milissegundos) a partir da qual um comando é considerado lento.
+LIMITE_CONSULTA_LENTA_MS = float(os.environ.get('SLOW_QUERY_MS', '500'))
+# Fração das consultas lentas que terão o EXPLAIN capturado (a primeira de cada local sempre é).
+AMOSTRAGEM_EXPLAIN = float(os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE', '0.1'))
+
+# Estatísticas por local da chamada: {local: {'sql', 'execucoes', 'total_ms', 'max_ms', 'lentas'}}.
+estatisticas_consultas = {}
+# As últimas consultas lentas, com o plano de execução quando capturado.
+consultas_lentas = deque(maxlen=50)
+trava_estatisticas = threading.Lock()
+
+# Funções da própria instrumentação, ignoradas ao procurar o local da chamada.
+FUNCOES_INSTRUMENTACAO = {'execute', 'copy_expert', 'registrar_consulta', 'local_da_chamada'}
+
+def local_da_chamada():
+    """Descobre qual função do app.py executou o comando SQL (ex: 'index:612')."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        codigo = frame.f_code
+        if codigo.co_filename == __file__ and codigo.co_name not in FUNCOES_INSTRUMENTACAO:
+            return f"{codigo.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return "desconhecido"
+
+# Cláusulas de trava de linhas: um SELECT com elas pega as travas de novo no ANALYZE.
+CLAUSULA_DE_TRAVA = re.compile(r'\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b', re.IGNORECASE)
+
+def capturar_explain(conn, sql, parametros):
+    """
+    Executa o EXPLAIN do comando em um cursor comum (não instrumentado) da mesma conexão.
+    Só um SELECT simples (sem FOR UPDATE/SHARE) usa ANALYZE, pois ele executa o comando de
+    novo; um WITH pode ter INSERT/UPDATE/DELETE dentro e fica só com o plano estimado.
+
+    O EXPLAIN roda dentro da transação de quem chamou, protegido por um SAVEPOINT que é
+    sempre desfeito (ROLLBACK TO) ao final: o que o ANALYZE tiver feito (efeitos de funções,
+    travas) não fica na transação, e se ele falhar (statement_timeout, cancelamento...) a
+    transação continua utilizável pelo resto da requisição.
+    """
+    import psycopg2.extensions
+
+    texto = sql.decode() if isinstance(sql, bytes) else sql
+    somente_leitura = texto.lstrip().upper().startswith('SELECT') and not CLAUSULA_DE_TRAVA.search(texto)
+    # Em modo autocommit não há transação a proteger (e SAVEPOINT não é permitido).
+    protegido = not conn.autocommit
+    opcoes = "(ANALYZE, BUFFERS)" if somente_leitura else ""
+    cur = None
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        if protegido:
+            cur.execute("SAVEPOINT capturar_explain")
+        try:
+            cur.execute(f"EXPLAIN {opcoes} {texto}", parametros)
+            return "\n".join(linha[0] for linha in cur.fetchall())
+        finally:
+            if protegido:
+                cur.execute("ROLLBACK TO SAVEPOINT capturar_explain")
+                cur.execute("RELEASE SAVEPOINT capturar_explain")
+    except Exception as e:
+        return f"Não foi possível capturar o EXPLAIN: {e}"
+    finally:
+        if cur is not None:
+            cur.close()
+
+def registrar_consulta(conn, sql, parametros, duracao_ms, capturar_plano=True, local=None):
+    """
+    Acumula a duração de um comando e registra (com EXPLAIN amostrado) se for lento.
+    'capturar_plano' é falso para comandos que falharam ou que não aceitam EXPLAIN (COPY).
+    'local' é informado quando o registro acontece longe do execute (cursores nomeados).
+    """
+    local = local or local_da_chamada()
+    texto = (sql.decode() if isinstance(sql, bytes) else str(sql)).strip()[:2000]
+    lenta = duracao_ms >= LIMITE_CONSULTA_LENTA_MS
+
+    with trava_estatisticas:
+        estat = estatisticas_consultas.setdefault(
+            local, {'sql': texto, 'execucoes': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'lentas': 0})
+        estat['execucoes'] += 1
+        estat['total_ms'] += duracao_ms
+        estat['max_ms'] = max(estat['max_ms'], duracao_ms)
+        if lenta:
+            estat['lentas'] += 1
+            primeira_lenta = estat['lentas'] == 1
+
+    if not lenta:
+        return
+
+    print(f"Consulta lenta ({duracao_ms:.0f} ms) em {local}: {texto[:200]}")
+    plano = None
+    if capturar_plano and (primeira_lenta or random.random() < AMOSTRAGEM_EXPLAIN):
+        plano = capturar_explain(conn, sql, parametros)
+
+    with trava_estatisticas:
+        consultas_lentas.appendleft({
+            'local': local,
+            'sql': texto,
+            'duracao_ms': duracao_ms,
+            'quando': datetime.now(),
+            'plano': plano,
+        })
+
+def linhas_medidas(conn, linhas, sql, parametros, duracao_ms, local):
+    """
+    Repassa as linhas de um cursor nomeado somando o tempo gasto em cada leitura (os FETCH
+    ao banco) à duração do DECLARE, e registra a consulta quando a leitura termina (ou é
+    abandonada). O tempo de quem consome as linhas não entra na conta.
+    """
+    erro = False
+    try:
+        while True:
+            inicio = perf_counter()
+            try:
+                linha = next(linhas)
+            except StopIteration:
+                return
+            except Exception:
+                erro = True
+                raise
+            finally:
+                duracao_ms += (perf_counter() - inicio) * 1000
+            yield linha
+    finally:
+        registrar_consulta(conn, sql, parametros, duracao_ms, capturar_plano=not erro, local=local)
+
+_classe_cursor_instrumentado = None
+
+def classe_cursor_instrumentado():
+    """
+    Retorna (criando na primeira chamada) a classe de cursor que mede cada comando.
+    A classe é criada sob demanda porque depende do psycopg2, que é importado de forma preguiçosa.
+    """
+    global _classe_cursor_instrumentado
+    if _classe_cursor_instrumentado is None:
+        import psycopg2.extensions
+
+        class CursorInstrumentado(psycopg2.extensions.cursor):
+            # Consulta de um cursor nomeado ainda não registrada: (sql, parametros, duracao_ms, local).
+            consulta_pendente = None
+
+            def execute(self, query, vars=None):
+                inicio = perf_counter()
+                erro = False
+                try:
+                    return super().execute(query, vars)
+                except Exception:
+                    erro = True
+                    raise
+                finally:
+                    duracao_ms = (perf_counter() - inicio) * 1000
+                    if self.name is not None and not erro:
+                        # Cursor nomeado (do lado do servidor): o execute só faz o DECLARE e as
+                        # linhas chegam depois, em FETCH durante a iteração. A consulta é
+                        # registrada quando a leitura termina, com o tempo dos FETCH somado.
+                        self.consulta_pendente = (query, vars, duracao_ms, local_da_chamada())
+                    else:
+                        registrar_consulta(self.connection, query, vars, duracao_ms,
+                                           capturar_plano=not erro)
+
+            def __iter__(self):
+                pendente = self.consulta_pendente
+                if pendente is None:
+                    return super().__iter__()
+                self.consulta_pendente = None
+                return linhas_medidas(self.connection, super().__iter__(), *pendente)
+
+            def close(self):
+                # Cursor nomeado fechado sem ser iterado: registra ao menos o DECLARE.
+                pendente = self.consulta_pendente
+                if pendente is not None:
+                    self.consulta_pendente = None
+                    sql, parametros, duracao_ms, local = pendente
+                    registrar_consulta(self.connection, sql, parametros, duracao_ms, local=local)
+                return super().close()
+
+            def copy_expert(self, sql, file, size=8192):
+                inicio = perf_counter()
+                try:
+                    return super().copy_expert(sql, file, size)
+                finally:
+                    # COPY não aceita EXPLAIN, então só a duração é registrada.
+                    registrar_consulta(self.connection, sql, None, (perf_counter() - inicio) * 1000,
+                                       capturar_plano=False)
+
+        _classe_cursor_instrumentado = CursorInstrumentado
+    return _classe_cursor_instrumentado
+
 def update_device_communication(sn):
     """
     Atualiza ou insere o horário da última comunicação de um dispositivo no banco de dados.
@@ -105,16 +320,168 @@ def init_db():
 # para o esquema do banco de dados.
 # init_db()
 
-# --- Dados Estáticos da Aplicação ---
-# Dicionário que mapeia o ID do funcionário (como vem do relógio) para o nome.
-# Em um sistema real, isso viria de uma tabela de 'funcionarios' no banco de dados.
+# --- Fazendas (Várias Fazendas na Mesma Instalação) ---
+# Cada fazenda tem o seu cadastro de funcionários (tabela 'funcionarios') e o código IBGE
+# do município, que define os feriados municipais. Cada equipamento é vinculado a uma
+# fazenda pelo número de série (dispositivos.fazenda_id) e toda batida gravada em registros
+# leva o fazenda_id do equipamento que a enviou.
+# Todas as consultas filtram pela fazenda e os índices começam por fazenda_id (ver migração
+# 8a9b0c1d2e3f): o dashboard de uma fazenda lê só as batidas dela, então acrescentar fazendas
+# não deixa as outras mais lentas.
+#
+# O administrador escolhe a fazenda exibida no dashboard (fica na sessão). Equipamentos ainda
+# não vinculados gravam na fazenda padrão, que é a que recebeu os dados de antes da migração.
+# Vincular um equipamento: flask --app app vincular-dispositivo SN123 2
+
+FAZENDA_PADRAO = 1
+# Código IBGE de Perdizes - MG, município da fazenda padrão.
+IBGE_PADRAO = "3149800"
+# Tempo (em segundos) que o cadastro de fazendas e funcionários fica em memória em cada processo.
+TTL_FAZENDAS = int(os.environ.get('FARM_CACHE_TTL', '300'))
+
+# Uma fazenda: id, nome, código IBGE e funcionários ({func_id: nome}).
+Fazenda = namedtuple('Fazenda', ['id', 'nome', 'ibge_code', 'funcionarios'])
+
+# Funcionários da fazenda padrão, usados enquanto o banco não responde (e nos dados fictícios do dashboard).
 funcionarios = {
     "1": "João",
     "2": "Maria",
 }
 
+# Cadastro em memória: {'expira_em': ..., 'fazendas': {id: Fazenda}}.
+cache_fazendas = {}
+trava_fazendas = threading.Lock()
+
+def fazendas_sem_banco():
+    """Cadastro mínimo (só a fazenda padrão) usado quando o banco não está acessível."""
+    return {FAZENDA_PADRAO: Fazenda(FAZENDA_PADRAO, 'Fazenda Ribeirão Preto', IBGE_PADRAO, funcionarios)}
+
+def carregar_fazendas():
+    """Lê do banco as fazendas e os funcionários de cada uma."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id, nome, ibge_code FROM fazendas ORDER BY id")
+        linhas = cur.fetchall()
+        cur.execute("SELECT fazenda_id, func_id, nome FROM funcionarios ORDER BY fazenda_id, func_id")
+        por_fazenda = {}
+        for fazenda_id, func_id, nome in cur.fetchall():
+            por_fazenda.setdefault(fazenda_id, {})[func_id] = nome
+        cur.close()
+    finally:
+        conn.close()
+    return {id: Fazenda(id, nome, ibge_code, por_fazenda.get(id, {})) for id, nome, ibge_code in linhas}
+
+def obter_fazendas():
+    """Retorna o cadastro de fazendas ({id: Fazenda}), lido do banco no máximo uma vez a cada TTL_FAZENDAS."""
+    with trava_fazendas:
+        if cache_fazendas and cache_fazendas['expira_em'] > monotonic():
+            return cache_fazendas['fazendas']
+    try:
+        fazendas = carregar_fazendas()
+    except Exception as e:
+        print(f"ALERTA: Não foi possível carregar o cadastro de fazendas: {e}")
+        return fazendas_sem_banco()
+    with trava_fazendas:
+        cache_fazendas.update(expira_em=monotonic() + TTL_FAZENDAS, fazendas=fazendas)
+    return fazendas
+
+def invalidar_fazendas():
+    """Descarta o cadastro em memória (depois de criar fazendas ou funcionários)."""
+    with trava_fazendas:
+        cache_fazendas.clear()
+
+def id_fazenda_atual():
+    """ID da fazenda escolhida pelo administrador na sessão (sem consultar o banco)."""
+    return session.get('fazenda_id', FAZENDA_PADRAO)
+
+def fazenda_atual():
+    """A fazenda escolhida pelo administrador na sessão (ou a padrão)."""
+    fazendas = obter_fazendas()
+    return (fazendas.get(id_fazenda_atual()) or fazendas.get(FAZENDA_PADRAO)
+            or fazendas_sem_banco()[FAZENDA_PADRAO])
+
+def fazenda_do_dispositivo(cur, sn):
+    """Fazenda à qual o equipamento está vinculado (a padrão se não estiver vinculado)."""
+    if not sn:
+        return FAZENDA_PADRAO
+    cur.execute("SELECT fazenda_id FROM dispositivos WHERE sn = %s", (sn,))
+    row = cur.fetchone()
+    return row[0] if row and row[0] is not None else FAZENDA_PADRAO
+
+@rotas.route('/fazenda', methods=['POST'])
+def selecionar_fazenda():
+    """Troca a fazenda exibida no dashboard (e usada nos relatórios e lançamentos)."""
+    if not session.get('logged_in'):
+        return redirect(url_for('ponto.login'))
+    try:
+        fazenda = obter_fazendas().get(int(request.form.get('fazenda_id', '')))
+    except ValueError:
+        fazenda = None
+    if fazenda is None:
+        flash('Fazenda não encontrada.')
+    else:
+        session['fazenda_id'] = fazenda.id
+    return redirect(url_for('ponto.index'))
+
+@click.command('criar-fazenda')
+@click.argument('nome')
+@click.argument('ibge_code')
+def comando_criar_fazenda(nome, ibge_code):
+    """Cadastra uma fazenda (IBGE_CODE é o código do município, usado nos feriados)."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO fazendas (nome, ibge_code) VALUES (%s, %s) RETURNING id", (nome, ibge_code))
+        fazenda_id = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    invalidar_fazendas()
+    print(f"Fazenda {nome} cadastrada com o id {fazenda_id}.")
+
+@click.command('cadastrar-funcionario')
+@click.argument('fazenda_id', type=int)
+@click.argument('func_id')
+@click.argument('nome')
+def comando_cadastrar_funcionario(fazenda_id, func_id, nome):
+    """Cadastra (ou renomeia) um funcionário de uma fazenda."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO funcionarios (fazenda_id, func_id, nome) VALUES (%s, %s, %s)
+            ON CONFLICT (fazenda_id, func_id) DO UPDATE SET nome = EXCLUDED.nome
+        """, (fazenda_id, func_id, nome))
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    invalidar_fazendas()
+    print(f"Funcionário {func_id} ({nome}) cadastrado na fazenda {fazenda_id}.")
+
+@click.command('vincular-dispositivo')
+@click.argument('sn')
+@click.argument('fazenda_id', type=int)
+def comando_vincular_dispositivo(sn, fazenda_id):
+    """Vincula um equipamento (pelo número de série) a uma fazenda."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        # O equipamento pode ainda não ter se comunicado (e não estar na tabela).
+        cur.execute("""
+            INSERT INTO dispositivos (sn, last_communication, fazenda_id) VALUES (%s, %s, %s)
+            ON CONFLICT (sn) DO UPDATE SET fazenda_id = EXCLUDED.fazenda_id
+        """, (sn, datetime.now(), fazenda_id))
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    print(f"Dispositivo {sn} vinculado à fazenda {fazenda_id}.")
+
 # --- Rotas de Autenticação (Login/Logout) ---
-@app.route('/login', methods=['GET', 'POST'])
+@rotas.route('/login', methods=['GET', 'POST'])
 def login():
     """Exibe a página de login e processa a tentativa de login."""
     # Se o usuário enviou o formulário (método POST).
@@ -127,14 +494,14 @@ def login():
             # Cria uma mensagem de sucesso para ser exibida na próxima página.
             flash('Login realizado com sucesso!')
             # Redireciona o usuário para a página principal ('index').
-            return redirect(url_for('index'))
+            return redirect(url_for('ponto.index'))
         else:
             # Se a senha estiver errada, cria uma mensagem de erro.
             flash('Senha incorreta!')
     # Se o método for GET (usuário apenas acessou a página), exibe o template de login.
     return render_template('login.html')
 
-@app.route('/logout')
+@rotas.route('/logout')
 def logout():
     """Remove o status de 'logado' da sessão e redireciona para a página de login."""
     # Remove a informação 'logged_in' da sessão do usuário.
@@ -142,17 +509,55 @@ def logout():
     # Cria uma mensagem informativa.
     flash('Você foi desconectado.')
     # Redireciona para a tela de login.
-    return redirect(url_for('login'))
+    return redirect(url_for('ponto.login'))
 
 # --- Funções de Lógica de Negócio ---
 
-@lru_cache(maxsize=10)
-def get_feriados(ano, ibge_code="3149800"):
+# --- Classificação dos Dias (Índice de Calendário) ---
+# Cada dia é classificado em um único byte: os 2 bits baixos dizem o dia da semana
+# (útil, sábado ou domingo) e os 2 bits seguintes dizem se é feriado e de qual esfera.
+DIA_UTIL = 0
+DIA_SABADO = 1
+DIA_DOMINGO = 2
+MASCARA_DIA_SEMANA = 0b0011
+
+FERIADO_NACIONAL = 1 << 2
+FERIADO_ESTADUAL = 2 << 2
+FERIADO_MUNICIPAL = 3 << 2
+MASCARA_FERIADO = 0b1100
+
+# Converte o 'type' devolvido pelas APIs de feriados para a nossa classificação.
+TIPOS_FERIADO = {
+    'national': FERIADO_NACIONAL,
+    'nacional': FERIADO_NACIONAL,
+    'state': FERIADO_ESTADUAL,
+    'estadual': FERIADO_ESTADUAL,
+    'municipal': FERIADO_MUNICIPAL,
+    'city': FERIADO_MUNICIPAL,
+    'local': FERIADO_MUNICIPAL,
+}
+
+# Feriados municipais usados no fallback de carregar_feriados, por código IBGE: [('MM-DD', nome)].
+FERIADOS_MUNICIPAIS_CONHECIDOS = {
+    # Perdizes - MG: 17/12 - Aniversário da Cidade (Lei Estadual 148 de 17/12/1938)
+    "3149800": [("12-17", "Aniversário de Perdizes")],
+}
+
+# Os caches abaixo guardam um ano por município (código IBGE): com várias fazendas, vários municípios.
+@lru_cache(maxsize=128)
+def carregar_feriados(ano, ibge_code=IBGE_PADRAO):
     """
     Busca feriados nacionais, estaduais e municipais.
     Tenta primeiro a API feriados.dev (conforme solicitado).
     Usa BrasilAPI + Feriados Locais Manuais como fallback caso a primeira falhe.
+
+    Returns:
+        dict: Mapeia a data ('YYYY-MM-DD') para uma tupla (nome, tipo), onde 'tipo'
+              é FERIADO_NACIONAL, FERIADO_ESTADUAL ou FERIADO_MUNICIPAL.
     """
+    # requests: Para fazer requisições HTTP para as APIs de feriados.
+    import requests
+
     feriados = {}
 
     # 1. Tentativa com feriados.dev
@@ -162,9 +567,10 @@ def get_feriados(ano, ibge_code="3149800"):
         response = requests.get(url, timeout=5)
         if response.status_code == 200:
             dados = response.json()
-            # Assume que a API retorna uma lista de objetos com 'date' e 'name'.
+            # Assume que a API retorna uma lista de objetos com 'date' e 'name' (e opcionalmente 'type').
             for f in dados:
-                feriados[f['date']] = f['name']
+                tipo = TIPOS_FERIADO.get(str(f.get('type', '')).lower(), FERIADO_NACIONAL)
+                feriados[f['date']] = (f['name'], tipo)
             print(f"Feriados carregados via feriados.dev para o ano {ano}")
             return feriados
     except Exception as e:
@@ -177,25 +583,248 @@ def get_feriados(ano, ibge_code="3149800"):
         if response.status_code == 200:
             dados = response.json()
             for f in dados:
-                feriados[f['date']] = f['date'] # Chave é a data, valor inicial pode ser o nome
                 # Alguns retornos da BrasilAPI usam 'name'
-                feriados[f['date']] = f.get('name', 'Feriado Nacional')
+                feriados[f['date']] = (f.get('name', 'Feriado Nacional'), FERIADO_NACIONAL)
     except Exception as e:
         print(f"Erro ao acessar BrasilAPI: {e}")
 
-    # 3. Adição manual de feriados municipais conhecidos de Perdizes - MG
-    # 17/12 - Aniversário da Cidade (Lei Estadual 148 de 17/12/1938)
-    feriados_locais = [
-        (f"{ano}-12-17", "Aniversário de Perdizes"),
-    ]
-
-    for data, nome in feriados_locais:
+    # 3. Adição manual dos feriados municipais conhecidos do município da fazenda.
+    for mes_dia, nome in FERIADOS_MUNICIPAIS_CONHECIDOS.get(ibge_code, []):
+        data = f"{ano}-{mes_dia}"
         if data not in feriados:
-            feriados[data] = nome
+            feriados[data] = (nome, FERIADO_MUNICIPAL)
 
     return feriados
 
-def processar_pontos_faltantes(registros_brutos, funcionarios_map):
+@lru_cache(maxsize=128)
+def get_feriados(ano, ibge_code=IBGE_PADRAO):
+    """Retorna os feriados do ano no formato {'YYYY-MM-DD': nome}."""
+    return {data: nome for data, (nome, _tipo) in carregar_feriados(ano, ibge_code).items()}
+
+class CalendarioAno:
+    """
+    Índice pré-calculado de um ano inteiro.
+
+    Guarda dois arrays compactos indexados pelo dia (data.toordinal() - inicio):
+    - tipos: a classificação do dia (dia da semana + esfera do feriado, se houver).
+    - limites: o limite de horas normais do dia, em minutos. Zero significa que
+      todas as horas do dia são extra 100% (domingos e feriados).
+    Assim, classificar um dia vira uma única leitura de array.
+    """
+
+    def __init__(self, ano, feriados):
+        self.ano = ano
+        self.inicio = date(ano, 1, 1).toordinal()
+        total_dias = date(ano, 12, 31).toordinal() - self.inicio + 1
+        self.tipos = array('B', bytes(total_dias))
+        self.limites = array('H', bytes(2 * total_dias))
+        # Nomes dos feriados, usados pelo calendário (FullCalendar) do dashboard.
+        self.feriados = {}
+
+        for i in range(total_dias):
+            # O ordinal 1 (01/01/0001) é uma segunda-feira, então (ordinal - 1) % 7 == weekday().
+            dia_semana = (self.inicio + i - 1) % 7
+            if dia_semana == 6:
+                self.tipos[i] = DIA_DOMINGO
+            elif dia_semana == 5:
+                self.tipos[i] = DIA_SABADO
+                self.limites[i] = 4 * 60
+            else:
+                self.limites[i] = 8 * 60
+
+        for data_iso, (nome, tipo) in feriados.items():
+            d = date.fromisoformat(data_iso)
+            if d.year != ano:
+                continue
+            i = d.toordinal() - self.inicio
+            self.tipos[i] |= tipo
+            self.limites[i] = 0
+            self.feriados[data_iso] = nome
+
+    def indice(self, data):
+        """Converte uma data para a posição dela nos arrays do índice."""
+        return data.toordinal() - self.inicio
+
+@lru_cache(maxsize=128)
+def get_calendario(ano, ibge_code=IBGE_PADRAO):
+    """Constrói (uma única vez por ano) o índice de calendário usado nos cálculos."""
+    return CalendarioAno(ano, carregar_feriados(ano, ibge_code))
+
+# --- Representação Compacta das Batidas (LoteBatidas) ---
+# Em vez de listas de tuplas com strings e objetos datetime (mais de 200 bytes por batida),
+# as batidas ficam em arrays de números: horário em segundos desde 01/01/1970 (int64),
+# índice do funcionário (int32), código da origem (int8) e id do registro (int64).
+# As justificativas, que são raras, ficam em um dicionário {posição: texto}.
+
+# Época usada para converter os horários (sem fuso, igual às colunas TIMESTAMP do banco).
+EPOCA = datetime(1970, 1, 1)
+ORDINAL_EPOCA = EPOCA.toordinal()
+SEGUNDOS_POR_DIA = 86400
+
+# Códigos das origens. O código é a posição na tupla.
+ORIGENS = ('equipamento', 'manual')
+CODIGO_ORIGEM = {origem: codigo for codigo, origem in enumerate(ORIGENS)}
+
+class LoteBatidas:
+    """
+    Lote de batidas de ponto armazenado em arrays compactos (colunas).
+
+    Pode ser criado a partir de um cursor do banco (LoteBatidas.do_cursor) ou de uma
+    lista de tuplas (LoteBatidas.de_tuplas) e é aceito pelas funções de cálculo e pela exportação.
+    """
+
+    def __init__(self):
+        # IDs distintos dos funcionários; 'funcionarios' guarda a posição nesta lista.
+        self.func_ids = []
+        self._posicao_func = {}
+        self.horarios = array('q')
+        self.funcionarios = array('i')
+        self.origens = array('b')
+        self.ids = array('q')
+        self.justificativas = {}
+
+    def __len__(self):
+        return len(self.horarios)
+
+    def adicionar(self, func_id, horario, origem='equipamento', justificativa=None, id=-1):
+        """Acrescenta uma batida ao lote."""
+        func_id = str(func_id)
+        posicao = self._posicao_func.get(func_id)
+        if posicao is None:
+            posicao = self._posicao_func[func_id] = len(self.func_ids)
+            self.func_ids.append(func_id)
+        if justificativa:
+            self.justificativas[len(self.horarios)] = justificativa
+        self.horarios.append((horario - EPOCA) // timedelta(seconds=1))
+        self.funcionarios.append(posicao)
+        self.origens.append(CODIGO_ORIGEM.get(origem, 0))
+        self.ids.append(id if id is not None else -1)
+
+    @classmethod
+    def de_tuplas(cls, registros):
+        """
+        Cria um lote a partir de tuplas no formato usado pelo resto do app:
+        (func_id, horario) ou (func_id, horario, origem, justificativa, id).
+        """
+        lote = cls()
+        for registro in registros:
+            lote.adicionar(*registro)
+        return lote
+
+    @classmethod
+    def do_cursor(cls, cur):
+        """
+        Cria um lote lendo as linhas de um cursor que executou um SELECT com as colunas
+        func_id, horario, origem, justificativa, id (nesta ordem). As linhas são lidas uma
+        a uma, sem montar a lista completa de tuplas (use um cursor nomeado do psycopg2
+        para que o banco também envie os dados aos poucos).
+        """
+        lote = cls()
+        for func_id, horario, origem, justificativa, id in cur:
+            lote.adicionar(func_id, horario, origem, justificativa, id)
+        return lote
+
+    def horario(self, i):
+        """Retorna o horário da batida 'i' como datetime."""
+        return EPOCA + timedelta(seconds=self.horarios[i])
+
+    def linha(self, i):
+        """Retorna a batida 'i' como tupla (func_id, horario, origem, justificativa, id)."""
+        return (self.func_ids[self.funcionarios[i]], self.horario(i), ORIGENS[self.origens[i]],
+                self.justificativas.get(i), self.ids[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.linha(i)
+
+    def ordem_decrescente(self):
+        """Posições das batidas da mais recente para a mais antiga."""
+        horarios = self.horarios
+        return sorted(range(len(self)), key=horarios.__getitem__, reverse=True)
+
+    def por_funcionario(self):
+        """
+        Agrupa os horários (em segundos) por funcionário, em ordem crescente.
+        Gera tuplas (func_id, horarios) com os funcionários ordenados pelo ID.
+        """
+        grupos = [array('q') for _ in self.func_ids]
+        for posicao, segundos in zip(self.funcionarios, self.horarios):
+            grupos[posicao].append(segundos)
+        for func_id in sorted(self.func_ids):
+            yield func_id, sorted(grupos[self._posicao_func[func_id]])
+
+    def para_dataframe(self):
+        """Converte o lote para um DataFrame do pandas (sem passar por tuplas Python)."""
+        import numpy as np
+        import pandas as pd
+
+        func_ids = np.array(self.func_ids, dtype=object)
+        justificativas = np.full(len(self), None, dtype=object)
+        for i, texto in self.justificativas.items():
+            justificativas[i] = texto
+        return pd.DataFrame({
+            'func_id': func_ids[np.asarray(self.funcionarios, dtype=np.int32)],
+            'horario': pd.to_datetime(np.asarray(self.horarios, dtype=np.int64), unit='s'),
+            'origem': np.array(ORIGENS, dtype=object)[np.asarray(self.origens, dtype=np.int8)],
+            'justificativa': justificativas,
+        })
+
+def como_lote(registros):
+    """Aceita um LoteBatidas ou uma lista de tuplas e sempre devolve um LoteBatidas."""
+    return registros if isinstance(registros, LoteBatidas) else LoteBatidas.de_tuplas(registros)
+
+def agrupar_por_dia(horarios):
+    """Agrupa horários (em segundos, já ordenados) por dia. Gera (ordinal_do_dia, horarios_do_dia)."""
+    for dia, grupo in groupby(horarios, key=lambda h: h // SEGUNDOS_POR_DIA):
+        yield dia + ORDINAL_EPOCA, list(grupo)
+
+def calendario_do_ordinal(ordinal, calendario=None, ibge_code=IBGE_PADRAO):
+    """Retorna o índice de calendário que contém o dia, reaproveitando o anterior quando possível."""
+    if calendario is None or not 0 <= ordinal - calendario.inicio < len(calendario.tipos):
+        calendario = get_calendario(date.fromordinal(ordinal).year, ibge_code)
+    return calendario
+
+def horas_trabalhadas_dia(registros_dia):
+    """
+    Soma o tempo trabalhado (em segundos) a partir das batidas do dia, em ordem cronológica.
+    As batidas formam pares (entrada, saída); se o número for ímpar, a última é ignorada.
+    """
+    if len(registros_dia) % 2 != 0:
+        registros_dia = registros_dia[:-1]
+    return sum(registros_dia[1::2]) - sum(registros_dia[0::2])
+
+def dividir_horas_dia(trabalhado, limite_minutos):
+    """
+    Divide o tempo trabalhado no dia (em segundos) em (normal, extra50, extra100).
+
+    Args:
+        trabalhado (int): Segundos trabalhados no dia.
+        limite_minutos (int): Limite de horas normais do dia, vindo do índice de calendário
+                              (8h de Seg-Sex, 4h aos sábados e zero em domingos e feriados).
+    """
+    # Regra: Domingos ou Feriados (limite zero) são 100% extra.
+    if limite_minutos == 0:
+        return 0, 0, trabalhado
+    limite_normal = limite_minutos * 60
+    # O que exceder o limite vira hora extra 50%.
+    if trabalhado > limite_normal:
+        return limite_normal, trabalhado - limite_normal, 0
+    # Se não excedeu o limite, todas as horas são normais.
+    return trabalhado, 0, 0
+
+def formatar_duracao(segundos):
+    """Formata uma duração em segundos como texto (ex: "10h 30m")."""
+    return f"{segundos // 3600}h {(segundos % 3600) // 60}m"
+
+# Horários de batida esperados para dias de semana e sábados (domingos não têm batidas esperadas).
+HORARIOS_ESPERADOS = {
+    DIA_UTIL: (time(7, 0), time(11, 0), time(13, 0), time(17, 0)),
+    DIA_SABADO: (time(7, 0), time(11, 0)),
+}
+# Tolerância entre a batida real e o horário esperado, em segundos.
+TOLERANCIA_BATIDA = 90 * 60
+
+def processar_pontos_faltantes(registros_brutos, funcionarios_map, ibge_code=IBGE_PADRAO):
     """
     Analisa todos os registros de ponto para encontrar batidas que foram esquecidas.
     A regra é: se um funcionário bateu ponto em um dia, ele deveria ter batido
@@ -203,69 +832,60 @@ def processar_pontos_faltantes(registros_brutos, funcionarios_map):
     uma batida real dentro de uma margem de tolerância (90 minutos).
 
     Args:
-        registros_brutos (list): Uma lista de tuplas, onde cada tupla é (id_funcionario, horario).
+        registros_brutos (LoteBatidas | list): As batidas, como LoteBatidas ou como
+            uma lista de tuplas (id_funcionario, horario).
         funcionarios_map (dict): O dicionário que mapeia ID para nome.
+        ibge_code (str): Município da fazenda, que define os feriados.
 
     Returns:
         list: Uma lista de dicionários, cada um representando uma batida faltante.
     """
-    # Define os horários de batida esperados para dias de semana e sábados.
-    horarios_semana = [time(7, 0), time(11, 0), time(13, 0), time(17, 0)]
-    horarios_sabado = [time(7, 0), time(11, 0)]
+    # Horários de batida esperados para dias de semana e sábados.
+    horarios_semana = HORARIOS_ESPERADOS[DIA_UTIL]
+    horarios_sabado = HORARIOS_ESPERADOS[DIA_SABADO]
+    tolerancia = TOLERANCIA_BATIDA
 
     # Lista onde armazenaremos as batidas que faltaram.
     batidas_faltantes = []
+    calendario = None
 
-    # Ordena os registros por funcionário e depois por data/hora para que o 'groupby' funcione corretamente.
-    registros_por_id = sorted(registros_brutos, key=lambda x: (x[0], x[1]))
-    # Agrupa todos os registros pelo ID do funcionário.
-    grupos_por_funcionario = groupby(registros_por_id, key=lambda x: x[0])
-
-    # Itera sobre cada funcionário e seus respectivos registros.
-    for func_id, registros_funcionario_raw in grupos_por_funcionario:
+    # Itera sobre cada funcionário e seus horários (em segundos, já em ordem crescente).
+    for func_id, horarios in como_lote(registros_brutos).por_funcionario():
         nome_funcionario = funcionarios_map.get(func_id, "Desconhecido")
 
-        # Agora, agrupa os registros deste funcionário por dia.
-        registros_por_dia = groupby(registros_funcionario_raw, key=lambda x: x[1].date())
-
-        # Itera sobre cada dia que o funcionário trabalhou.
-        for data, registros_dia_raw in registros_por_dia:
-            # Converte o grupo de registros para uma lista de horários.
-            registros_do_dia = [r[1] for r in registros_dia_raw]
+        # Agora, agrupa os registros deste funcionário por dia e itera sobre cada dia trabalhado.
+        for ordinal, registros_do_dia in agrupar_por_dia(horarios):
+            # Consulta o índice de calendário do ano (construído uma única vez).
+            calendario = calendario_do_ordinal(ordinal, calendario, ibge_code)
+            dia_semana = calendario.tipos[ordinal - calendario.inicio] & MASCARA_DIA_SEMANA
 
-            # Se for um domingo (weekday() == 6), pula para o próximo dia.
-            if data.weekday() == 6:
+            # Se for um domingo, pula para o próximo dia.
+            if dia_semana == DIA_DOMINGO:
                 continue
 
             # Decide qual lista de horários esperados usar (semana ou sábado).
-            horarios_esperados = horarios_sabado if data.weekday() == 5 else horarios_semana
+            horarios_esperados = horarios_sabado if dia_semana == DIA_SABADO else horarios_semana
+            inicio_do_dia = (ordinal - ORDINAL_EPOCA) * SEGUNDOS_POR_DIA
 
             # Para cada horário que era esperado no dia...
             for esperado in horarios_esperados:
-                encontrado = False
-                # Cria um objeto datetime completo para o horário esperado.
-                horario_esperado_dt = datetime.combine(data, esperado)
-
-                # ...verifica cada batida que realmente aconteceu no dia.
-                for batida in registros_do_dia:
-                    # Se a diferença entre a batida real e a esperada for de até 90 minutos...
-                    if abs(batida - horario_esperado_dt) <= timedelta(minutes=90):
-                        # ...consideramos que a batida foi encontrada e podemos parar de procurar.
-                        encontrado = True
-                        break
-
-                # Se, após verificar todas as batidas do dia, não encontramos uma correspondente...
+                horario_esperado = inicio_do_dia + esperado.hour * 3600 + esperado.minute * 60
+
+                # ...verifica se alguma batida do dia ficou a até 90 minutos dele.
+                encontrado = any(abs(batida - horario_esperado) <= tolerancia for batida in registros_do_dia)
+
+                # Se não encontramos uma batida correspondente...
                 if not encontrado:
                     # ...adicionamos um registro à nossa lista de batidas faltantes.
                     batidas_faltantes.append({
                         "funcionario": nome_funcionario,
-                        "data": data.strftime('%d/%m/%Y'),
+                        "data": date.fromordinal(ordinal).strftime('%d/%m/%Y'),
                         "horario_faltante": esperado.strftime('%H:%M')
                     })
 
     return batidas_faltantes
 
-def calcular_horas_trabalhadas(registros_brutos, funcionarios_map):
+def calcular_horas_trabalhadas(registros_brutos, funcionarios_map, ibge_code=IBGE_PADRAO):
     """
     Calcula o total de horas trabalhadas por cada funcionário, separando em
     horas normais, extras com 50% e extras com 100%.
@@ -277,83 +897,410 @@ def calcular_horas_trabalhadas(registros_brutos, funcionarios_map):
     - Batidas ímpares: A última batida do dia é ignorada.
 
     Args:
-        registros_brutos (list): Uma lista de tuplas (id_funcionario, horario).
+        registros_brutos (LoteBatidas | list): As batidas, como LoteBatidas ou como
+            uma lista de tuplas (id_funcionario, horario).
         funcionarios_map (dict): O dicionário que mapeia ID para nome.
+        ibge_code (str): Município da fazenda, que define os feriados.
 
     Returns:
         dict: Um dicionário onde as chaves são nomes de funcionários e os valores
               são outros dicionários com as horas formatadas.
     """
-    # Cria uma estrutura para armazenar as horas de cada funcionário, iniciando com zero.
-    resumo_horas = {nome: {'normal': timedelta(), 'extra50': timedelta(), 'extra100': timedelta()} for nome in funcionarios_map.values()}
+    # Cria uma estrutura para armazenar as horas (em segundos) de cada funcionário, iniciando com zero.
+    resumo_horas = {nome: {'normal': 0, 'extra50': 0, 'extra100': 0} for nome in funcionarios_map.values()}
+    calendario = None
 
-    # Busca os feriados para todos os anos presentes nos registros para garantir o cálculo correto.
-    anos_presentes = set(r[1].year for r in registros_brutos)
-    todos_feriados = {}
-    for ano in anos_presentes:
-        todos_feriados.update(get_feriados(ano))
+    for func_id, horarios in como_lote(registros_brutos).por_funcionario():
+        nome_funcionario = funcionarios_map.get(func_id, "Desconhecido")
+        horas = resumo_horas.setdefault(nome_funcionario, {'normal': 0, 'extra50': 0, 'extra100': 0})
 
-    # Agrupa os registros por funcionário, similar à função anterior.
-    registros_por_id = sorted(registros_brutos, key=lambda x: (x[0], x[1]))
-    grupos_por_funcionario = groupby(registros_por_id, key=lambda x: x[0])
+        # Agrupa os registros do funcionário por dia (já estão em ordem cronológica).
+        for ordinal, registros_dia in agrupar_por_dia(horarios):
+            # Soma os intervalos (saída - entrada) de cada par de batidas do dia.
+            # Se o número de batidas for ímpar, a última não tem um par de "saída" e é ignorada.
+            trabalhado_dia = horas_trabalhadas_dia(registros_dia)
 
-    for func_id, registros_funcionario in grupos_por_funcionario:
-        nome_funcionario = funcionarios_map.get(func_id, "Desconhecido")
+            # Classifica as horas calculadas (normais, extra 50%, extra 100%).
+            # O índice de calendário já traz o limite de horas normais do dia (em minutos).
+            calendario = calendario_do_ordinal(ordinal, calendario, ibge_code)
+            normal, extra50, extra100 = dividir_horas_dia(trabalhado_dia, calendario.limites[ordinal - calendario.inicio])
+            horas['normal'] += normal
+            horas['extra50'] += extra50
+            horas['extra100'] += extra100
+
+    # Formata os totais (em segundos) para uma string mais legível (ex: "10h 30m").
+    resultado_formatado = {}
+    for nome, horas in resumo_horas.items():
+        resultado_formatado[nome] = {tipo: formatar_duracao(segundos) for tipo, segundos in horas.items()}
 
-        # Agrupa os registros do funcionário por dia.
-        registros_por_dia = groupby(registros_funcionario, key=lambda x: x[1].date())
+    return resultado_formatado
 
-        for data, registros_dia_raw in registros_por_dia:
-            # Ordena as batidas do dia para garantir que estão em ordem cronológica.
-            registros_dia = sorted([r[1] for r in registros_dia_raw])
+# --- Motor SQL dos Relatórios (cálculo dentro do Postgres) ---
+# Alternativa a calcular_horas_trabalhadas e processar_pontos_faltantes que aplica as mesmas
+# regras dentro do banco: as batidas são pareadas (entrada, saída) com funções de janela
+# (row_number/lead), a batida ímpar do fim do dia é descartada, cada dia é classificado pelo
+# índice de calendário e os limites de 8h/4h são aplicados. Só os totais por funcionário e
+# as batidas faltantes voltam para o Python.
+#
+# Os feriados vêm das APIs externas (carregar_feriados), então o calendário é enviado na
+# própria consulta: arrays com o dia, o limite de horas normais e o tipo do dia, montados
+# a partir do mesmo CalendarioAno que o motor Python usa.
+#
+# O motor de cada relatório é escolhido por variável de ambiente (MOTOR_HORAS, MOTOR_FALTANTES)
+# ou, no dashboard, pelos parâmetros ?motor_horas=sql e ?motor_faltantes=sql.
+# O comando 'flask validar-motor-sql' compara os dois motores com os dados reais.
+# As consultas filtram a fazenda (índice fazenda_id, horario) e o calendário é o do município dela.
+
+MOTORES = ('python', 'sql')
+# Motor padrão de cada relatório.
+MOTORES_RELATORIOS = {
+    'horas': os.environ.get('MOTOR_HORAS', 'python'),
+    'faltantes': os.environ.get('MOTOR_FALTANTES', 'python'),
+}
 
-            # Se o número de batidas for ímpar, a última não tem um par de "saída", então a removemos.
-            if len(registros_dia) % 2 != 0:
-                registros_dia = registros_dia[:-1]
+def filtro_periodo(inicio=None, fim=None, coluna='horario', fazenda_id=None):
+    """Monta a condição SQL (e os parâmetros) para as batidas da fazenda com horario em [inicio, fim)."""
+    condicoes, parametros = [], []
+    if fazenda_id is not None:
+        condicoes.append("fazenda_id = %s")
+        parametros.append(fazenda_id)
+    if inicio is not None:
+        condicoes.append(f"{coluna} >= %s")
+        parametros.append(inicio)
+    if fim is not None:
+        condicoes.append(f"{coluna} < %s")
+        parametros.append(fim)
+    return " AND ".join(condicoes) or "TRUE", parametros
+
+def calendario_sql(cur, inicio=None, fim=None, fazenda_id=FAZENDA_PADRAO, ibge_code=IBGE_PADRAO):
+    """
+    Monta os arrays do calendário (dias, limites em minutos, tipo do dia) para todos os
+    anos que têm registros da fazenda no período. Retorna None se não houver registros.
+    """
+    filtro, parametros = filtro_periodo(inicio, fim, fazenda_id=fazenda_id)
+    cur.execute(f"SELECT MIN(horario), MAX(horario) FROM registros WHERE {filtro}", parametros)
+    primeiro, ultimo = cur.fetchone()
+    if primeiro is None:
+        return None
+
+    dias, limites, tipos = [], [], []
+    for ano in range(primeiro.year, ultimo.year + 1):
+        calendario = get_calendario(ano, ibge_code)
+        for i in range(len(calendario.tipos)):
+            dias.append(date.fromordinal(calendario.inicio + i))
+            limites.append(calendario.limites[i])
+            tipos.append(calendario.tipos[i] & MASCARA_DIA_SEMANA)
+    return dias, limites, tipos
+
+def calcular_horas_trabalhadas_sql(conn, funcionarios_map, inicio=None, fim=None,
+                                   fazenda_id=FAZENDA_PADRAO, ibge_code=IBGE_PADRAO):
+    """
+    Mesmo resultado de calcular_horas_trabalhadas, calculado no Postgres.
 
-            # Calcula o total de tempo trabalhado no dia.
-            horas_trabalhadas_dia = timedelta()
-            # Itera sobre as batidas em pares (entrada, saída).
-            for i in range(0, len(registros_dia), 2):
-                entrada = registros_dia[i]
-                saida = registros_dia[i+1]
-                # Soma o intervalo de tempo ao total do dia.
-                horas_trabalhadas_dia += saida - entrada
+    Args:
+        conn: Conexão com o banco.
+        funcionarios_map (dict): O dicionário que mapeia ID para nome.
+        inicio, fim (datetime | None): Período [inicio, fim) dos registros (None = sem limite).
+        fazenda_id (int), ibge_code (str): A fazenda dos registros e o município dela.
+    """
+    resumo_horas = {nome: {'normal': 0, 'extra50': 0, 'extra100': 0} for nome in funcionarios_map.values()}
+    cur = conn.cursor()
+    calendario = calendario_sql(cur, inicio, fim, fazenda_id, ibge_code)
+    if calendario is not None:
+        dias, limites, _ = calendario
+        filtro, parametros = filtro_periodo(inicio, fim, fazenda_id=fazenda_id)
+        # Os horários são truncados no segundo, como nos arrays do LoteBatidas.
+        cur.execute(f"""
+            WITH batidas AS (
+                SELECT func_id, horario::date AS dia,
+                       row_number() OVER dia AS n,
+                       EXTRACT(EPOCH FROM lead(date_trunc('second', horario)) OVER dia
+                                          - date_trunc('second', horario))::bigint AS ate_a_proxima
+                FROM registros
+                WHERE {filtro}
+                WINDOW dia AS (PARTITION BY func_id, horario::date ORDER BY horario)
+            ),
+            dias AS (
+                -- Pares (1ª, 2ª), (3ª, 4ª)...: só as batidas ímpares abrem um intervalo.
+                -- A última batida de um dia ímpar não tem a próxima (lead nulo) e fica de fora.
+                SELECT func_id, dia, COALESCE(SUM(ate_a_proxima) FILTER (WHERE n %% 2 = 1), 0) AS trabalhado
+                FROM batidas
+                GROUP BY func_id, dia
+            ),
+            calendario AS (
+                SELECT * FROM unnest(%s::date[], %s::integer[]) AS c(dia, limite_min)
+            )
+            SELECT d.func_id,
+                   SUM(CASE WHEN c.limite_min = 0 THEN 0 ELSE LEAST(d.trabalhado, c.limite_min * 60) END),
+                   SUM(CASE WHEN c.limite_min = 0 THEN 0 ELSE GREATEST(d.trabalhado - c.limite_min * 60, 0) END),
+                   SUM(CASE WHEN c.limite_min = 0 THEN d.trabalhado ELSE 0 END)
+            FROM dias d
+            JOIN calendario c ON c.dia = d.dia
+            GROUP BY d.func_id
+        """, parametros + [dias, limites])
+
+        for func_id, normal, extra50, extra100 in cur.fetchall():
+            nome_funcionario = funcionarios_map.get(func_id, "Desconhecido")
+            horas = resumo_horas.setdefault(nome_funcionario, {'normal': 0, 'extra50': 0, 'extra100': 0})
+            horas['normal'] += int(normal)
+            horas['extra50'] += int(extra50)
+            horas['extra100'] += int(extra100)
+    cur.close()
+
+    return {nome: {tipo: formatar_duracao(segundos) for tipo, segundos in horas.items()}
+            for nome, horas in resumo_horas.items()}
+
+def processar_pontos_faltantes_sql(conn, funcionarios_map, inicio=None, fim=None,
+                                   fazenda_id=FAZENDA_PADRAO, ibge_code=IBGE_PADRAO):
+    """
+    Mesmo resultado de processar_pontos_faltantes, calculado no Postgres.
+    Só as batidas faltantes (funcionário, dia, horário esperado) voltam do banco.
+    """
+    cur = conn.cursor()
+    calendario = calendario_sql(cur, inicio, fim, fazenda_id, ibge_code)
+    if calendario is None:
+        cur.close()
+        return []
+    dias, _, tipos = calendario
+
+    tipos_esperados, horas_esperadas = [], []
+    for tipo, horarios in HORARIOS_ESPERADOS.items():
+        tipos_esperados += [tipo] * len(horarios)
+        horas_esperadas += list(horarios)
+
+    filtro, parametros = filtro_periodo(inicio, fim, fazenda_id=fazenda_id)
+    # As batidas de cada dia (truncadas no segundo) ficam em um array: a busca por uma batida
+    # próxima do horário esperado olha só as batidas daquele funcionário naquele dia.
+    cur.execute(f"""
+        WITH dias AS (
+            SELECT func_id, horario::date AS dia, array_agg(date_trunc('second', horario)) AS batidas
+            FROM registros
+            WHERE {filtro}
+            GROUP BY func_id, horario::date
+        ),
+        calendario AS (
+            SELECT * FROM unnest(%s::date[], %s::integer[]) AS c(dia, tipo)
+        ),
+        esperados AS (
+            SELECT * FROM unnest(%s::integer[], %s::time[]) AS e(tipo, hora)
+        )
+        SELECT d.func_id, d.dia, e.hora
+        FROM dias d
+        JOIN calendario c ON c.dia = d.dia
+        JOIN esperados e ON e.tipo = c.tipo
+        WHERE NOT EXISTS (
+            SELECT 1 FROM unnest(d.batidas) AS b(horario)
+            WHERE b.horario BETWEEN d.dia + e.hora - make_interval(secs => %s)
+                                AND d.dia + e.hora + make_interval(secs => %s)
+        )
+        ORDER BY d.func_id COLLATE "C", d.dia, e.hora
+    """, parametros + [dias, tipos, tipos_esperados, horas_esperadas, TOLERANCIA_BATIDA, TOLERANCIA_BATIDA])
+
+    batidas_faltantes = [{
+        "funcionario": funcionarios_map.get(func_id, "Desconhecido"),
+        "data": dia.strftime('%d/%m/%Y'),
+        "horario_faltante": hora.strftime('%H:%M'),
+    } for func_id, dia, hora in cur.fetchall()]
+    cur.close()
+    return batidas_faltantes
 
-            # Classifica as horas calculadas (normais, extra 50%, extra 100%).
-            dia_semana = data.weekday() # Segunda-feira é 0, Domingo é 6.
-            data_iso = data.strftime('%Y-%m-%d')
+def motor_do_relatorio(relatorio):
+    """Motor escolhido para o relatório: parâmetro motor_<relatorio> da requisição ou o padrão."""
+    motor = request.args.get(f"motor_{relatorio}") or MOTORES_RELATORIOS[relatorio]
+    return motor if motor in MOTORES else 'python'
 
-            # Regra: Domingos ou Feriados são 100% extra.
-            if dia_semana == 6 or data_iso in todos_feriados:
-                resumo_horas[nome_funcionario]['extra100'] += horas_trabalhadas_dia
-            else:
-                # Define o limite de horas normais para o dia.
-                limite_normal = timedelta(hours=8) if dia_semana < 5 else timedelta(hours=4) # < 5 é Seg-Sex
-
-                # Compara o total trabalhado com o limite.
-                if horas_trabalhadas_dia > limite_normal:
-                    # Adiciona as horas normais até o limite.
-                    resumo_horas[nome_funcionario]['normal'] += limite_normal
-                    # O que exceder o limite vira hora extra 50%.
-                    resumo_horas[nome_funcionario]['extra50'] += horas_trabalhadas_dia - limite_normal
-                else:
-                    # Se não excedeu o limite, todas as horas são normais.
-                    resumo_horas[nome_funcionario]['normal'] += horas_trabalhadas_dia
+def comparar_motores(conn, fazenda, inicio=None, fim=None):
+    """
+    Executa os dois motores com os mesmos registros da fazenda e retorna as diferenças
+    encontradas (listas vazias quando os resultados são idênticos).
+    """
+    funcionarios_map = fazenda.funcionarios
+    filtro, parametros = filtro_periodo(inicio, fim, fazenda_id=fazenda.id)
+    cur = conn.cursor(name='registros_validacao')
+    cur.itersize = 5000
+    cur.execute(f"SELECT func_id, horario, origem, justificativa, id FROM registros WHERE {filtro}", parametros)
+    lote = LoteBatidas.do_cursor(cur)
+    cur.close()
+
+    horas_python = calcular_horas_trabalhadas(lote, funcionarios_map, fazenda.ibge_code)
+    horas_sql = calcular_horas_trabalhadas_sql(conn, funcionarios_map, inicio, fim, fazenda.id, fazenda.ibge_code)
+    faltantes_python = processar_pontos_faltantes(lote, funcionarios_map, fazenda.ibge_code)
+    faltantes_sql = processar_pontos_faltantes_sql(conn, funcionarios_map, inicio, fim, fazenda.id, fazenda.ibge_code)
+
+    diferencas_horas = [(nome, horas_python.get(nome), horas_sql.get(nome))
+                        for nome in sorted(set(horas_python) | set(horas_sql))
+                        if horas_python.get(nome) != horas_sql.get(nome)]
+    chave = lambda f: (f['funcionario'], f['data'], f['horario_faltante'])
+    so_python = sorted(set(map(chave, faltantes_python)) - set(map(chave, faltantes_sql)))
+    so_sql = sorted(set(map(chave, faltantes_sql)) - set(map(chave, faltantes_python)))
+    return {
+        'registros': len(lote),
+        'horas': diferencas_horas,
+        'faltantes_so_python': so_python,
+        'faltantes_so_sql': so_sql,
+    }
+
+@click.command('validar-motor-sql')
+@click.option('--inicio', default=None, help='Início do período (AAAA-MM-DD).')
+@click.option('--fim', default=None, help='Fim do período, exclusivo (AAAA-MM-DD).')
+@click.option('--fazenda', 'fazenda_id', default=FAZENDA_PADRAO, help='ID da fazenda.')
+def comando_validar_motor_sql(inicio, fim, fazenda_id):
+    """Compara os relatórios do motor SQL com os do motor Python."""
+    inicio = datetime.strptime(inicio, '%Y-%m-%d') if inicio else None
+    fim = datetime.strptime(fim, '%Y-%m-%d') if fim else None
+    fazenda = obter_fazendas().get(fazenda_id)
+    if fazenda is None:
+        raise click.ClickException(f"Fazenda {fazenda_id} não encontrada.")
+    conn = get_db_connection()
+    try:
+        resultado = comparar_motores(conn, fazenda, inicio, fim)
+    finally:
+        conn.close()
 
-    # Formata os objetos timedelta para uma string mais legível (ex: "10h 30m").
-    resultado_formatado = {}
-    for nome, horas in resumo_horas.items():
-        resultado_formatado[nome] = {
-            'normal': f"{int(horas['normal'].total_seconds() // 3600)}h {int((horas['normal'].total_seconds() % 3600) // 60)}m",
-            'extra50': f"{int(horas['extra50'].total_seconds() // 3600)}h {int((horas['extra50'].total_seconds() % 3600) // 60)}m",
-            'extra100': f"{int(horas['extra100'].total_seconds() // 3600)}h {int((horas['extra100'].total_seconds() % 3600) // 60)}m",
-        }
+    diferencas = resultado['horas'] or resultado['faltantes_so_python'] or resultado['faltantes_so_sql']
+    print(f"{resultado['registros']} registros comparados.")
+    for nome, python, sql in resultado['horas']:
+        print(f"Horas de {nome}: python={python} sql={sql}")
+    for faltante in resultado['faltantes_so_python']:
+        print(f"Batida faltante só no motor Python: {faltante}")
+    for faltante in resultado['faltantes_so_sql']:
+        print(f"Batida faltante só no motor SQL: {faltante}")
+    if diferencas:
+        raise SystemExit(1)
+    print("Os dois motores deram o mesmo resultado.")
+
+# --- Sincronização de Logs por Dispositivo (cursor 'logindex') ---
+# Cada frame 'sendlog' do EVO traz 'logindex' (posição do primeiro registro na memória
+# do equipamento) e 'count' (quantidade de registros). Guardamos em dispositivos.last_logindex
+# o último índice gravado sem lacunas. Com isso:
+# - Registros repetidos (índice <= cursor) são descartados sem duplicar pontos.
+# - Se chegar um frame que começa depois de cursor + 1, há uma lacuna: o frame é recusado
+#   (o equipamento mantém os logs) e o servidor pede os registros a partir do cursor.
+# - Se a resposta a esse pedido ainda começar depois de cursor + 1, o equipamento não tem mais
+#   os registros da lacuna (memória apagada, registros excluídos): a página é aceita, a lacuna
+#   vai para o log e o cursor pula por cima dela, em vez de pedir a mesma página para sempre.
+# - dispositivos.last_log_time guarda o horário (relógio do equipamento) do registro do cursor;
+#   um frame com índices já gravados mas batidas mais novas que ele indica que o índice recomeçou.
+# - Ao reconectar, o servidor pede apenas o que veio depois do cursor, em páginas grandes.
+
+# Quantidade de registros pedida ao equipamento em cada página de sincronização.
+TAMANHO_PAGINA_LOGS = 500
+
+def obter_cursor_dispositivo(sn):
+    """Retorna o último logindex gravado do dispositivo (ou None se não houver)."""
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT last_logindex FROM dispositivos WHERE sn = %s", (sn,))
+        row = cur.fetchone()
+        cur.close()
+        conn.close()
+        return row[0] if row else None
+    except Exception as e:
+        print(f"Erro ao buscar cursor de sincronização do dispositivo {sn}: {e}")
+        return None
 
-    return resultado_formatado
+def comando_pedir_logs(inicio):
+    """Monta o comando que pede ao equipamento uma página de logs a partir de 'inicio'."""
+    return {"cmd": "getlog", "logindex": inicio, "count": TAMANHO_PAGINA_LOGS}
+
+def ingerir_logs_dispositivo(sn, logindex, logs, aceitar_lacuna=False):
+    """
+    Grava um frame de logs de um dispositivo respeitando o cursor de sincronização.
+    Os pontos e o avanço do cursor são gravados na mesma transação, na fazenda do dispositivo.
+
+    Args:
+        sn (str): Número de série do dispositivo.
+        logindex (int | None): Índice do primeiro registro do frame (None para
+                               equipamentos que não informam o índice).
+        logs (list): Os registros do frame (chave 'record' da mensagem).
+        aceitar_lacuna (bool): Grava o frame mesmo que ele comece depois de cursor + 1 (resposta
+                               a um 'getlog' que pediu a lacuna: o equipamento não tem mais
+                               aqueles registros). A lacuna vai para o log e o cursor pula por cima.
+
+    Returns:
+        dict: {'sucesso': bool, 'inseridos': int, 'cursor': int | None,
+               'lacuna': (inicio, fim) | None}
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+
+        # Trava a linha do dispositivo para que duas conexões do mesmo equipamento
+        # não avancem o cursor ao mesmo tempo.
+        cur.execute("SELECT last_logindex, fazenda_id, last_log_time FROM dispositivos WHERE sn = %s FOR UPDATE", (sn,))
+        row = cur.fetchone()
+        cursor_atual = row[0] if row else None
+        fazenda_id = row[1] if row and row[1] is not None else FAZENDA_PADRAO
+        horario_do_cursor = row[2] if row else None
+        novo_cursor = cursor_atual
+        novos = logs
+        # (func_id, horario) das batidas inseridas, para invalidar os resumos em cache.
+        gravadas = []
+
+        if logindex is not None:
+            if cursor_atual is not None and logindex > cursor_atual + 1:
+                if not aceitar_lacuna:
+                    # Lacuna: faltam os registros entre o cursor e o início deste frame.
+                    conn.rollback()
+                    return {'sucesso': False, 'inseridos': 0, 'cursor': cursor_atual,
+                            'lacuna': (cursor_atual + 1, logindex - 1)}
+                print(f"Registros {cursor_atual + 1} a {logindex - 1} do dispositivo {sn} não existem mais "
+                      f"no equipamento; cursor avançado por cima da lacuna")
+            if cursor_atual is not None and logindex <= cursor_atual:
+                # Índices que o cursor diz já terem sido gravados. Num reenvio (queda de conexão)
+                # as batidas não são mais novas que a do cursor (as duas no relógio do equipamento);
+                # se alguma for, o índice do equipamento recomeçou (memória apagada, reset de fábrica
+                # ou estouro do contador) e descartá-las perderia batidas que o equipamento vai
+                # apagar ao receber o OK.
+                repetidos = logs[:cursor_atual + 1 - logindex]
+                if horario_do_cursor is not None and any(
+                        datetime.strptime(batida.get("time"), '%Y-%m-%d %H:%M:%S') > horario_do_cursor
+                        for batida in repetidos):
+                    print(f"Índice do dispositivo {sn} recomeçou ({logindex} <= cursor {cursor_atual}); "
+                          f"cursor reiniciado")
+                    cursor_atual = None
+                else:
+                    # Descarta o que já foi gravado (reenvio após queda de conexão).
+                    novos = logs[cursor_atual + 1 - logindex:]
+            if logs:
+                novo_cursor = max(logindex + len(logs) - 1, cursor_atual if cursor_atual is not None else -1)
+
+        if novos:
+            # Um único INSERT com várias linhas para o frame inteiro.
+            valores = ", ".join(["(%s, %s, %s, %s)"] * len(novos))
+            parametros = []
+            for batida in novos:
+                horario = datetime.strptime(batida.get("time"), '%Y-%m-%d %H:%M:%S')
+                parametros += [fazenda_id, str(batida.get("enrollid")), horario, 'equipamento']
+                gravadas.append((str(batida.get("enrollid")), horario))
+            cur.execute(f"INSERT INTO registros (fazenda_id, func_id, horario, origem) VALUES {valores}", parametros)
+
+        if novo_cursor != cursor_atual:
+            # O cursor só avança até o fim deste frame, então o registro dele está no frame.
+            horario_do_cursor = datetime.strptime(logs[novo_cursor - logindex].get("time"), '%Y-%m-%d %H:%M:%S')
+            cur.execute("""
+                UPDATE dispositivos SET last_logindex = %s, last_log_time = %s, last_sync = %s WHERE sn = %s
+            """, (novo_cursor, horario_do_cursor, datetime.now(), sn))
+
+        conn.commit()
+        invalidar_resumos(gravadas, fazenda_id)
+        print(f"{len(novos)} ponto(s) registrado(s) do dispositivo {sn} (cursor: {novo_cursor})")
+        return {'sucesso': True, 'inseridos': len(novos), 'cursor': novo_cursor, 'lacuna': None}
+    except Exception as e:
+        print(f"Erro ao gravar logs do dispositivo {sn}: {e}")
+        if conn:
+            conn.rollback() # Desfaz a transação em caso de erro.
+        return {'sucesso': False, 'inseridos': 0, 'cursor': None, 'lacuna': None}
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
 
 # --- Rotas e Funções para Webhook EVO via WebSocket ---
-@sock.route('/api/v1/evo')
 def evo_webhook(ws):
     """
     Endpoint WebSocket para comunicação com o dispositivo EVO.
@@ -395,82 +1342,260 @@ def evo_webhook(ws):
                 ws.send(json.dumps(response_dict))
                 print(f"Enviado resposta 'reg': {json.dumps(response_dict)}")
 
+                # Reconexão: pede apenas os registros posteriores ao cursor salvo.
+                cursor = obter_cursor_dispositivo(sn) if sn else None
+                if cursor is not None:
+                    ws.send(json.dumps(comando_pedir_logs(cursor + 1)))
+                    print(f"Solicitados logs do SN {sn} a partir do índice {cursor + 1}")
+
             # --- LÓGICA PARA O COMANDO 'sendlog' (ENVIO DE REGISTROS) ---
             elif comando == "sendlog":
                 # A documentação indica que os registros vêm na chave 'record'.
                 logs = data.get("record", [])
-                conn = None
-                cur = None
-                success = False
-                try:
-                    conn = get_db_connection()
-                    cur = conn.cursor()
-
-                    # Itera sobre cada registro de ponto recebido.
-                    for batida in logs:
-                        user_id = batida.get("enrollid")
-                        horario_str = batida.get("time")
-                        horario = datetime.strptime(horario_str, '%Y-%m-%d %H:%M:%S')
-
-                        # Insere o registro no banco de dados.
-                        cur.execute("INSERT INTO registros (func_id, horario, origem) VALUES (%s, %s, %s)",
-                                    (str(user_id), horario, 'equipamento'))
-
-                        print(f"Ponto registrado! Usuário: {user_id} em {horario_str}")
-
-                    conn.commit()
-                    success = True # Marca como sucesso se a transação for concluída.
-                except (Exception, psycopg2.Error) as e:
-                    print(f"Erro ao processar 'sendlog': {e}")
-                    if conn:
-                        conn.rollback() # Desfaz a transação em caso de erro.
-                finally:
-                    if cur:
-                        cur.close()
-                    if conn:
-                        conn.close()
+                resultado = ingerir_logs_dispositivo(sn, data.get("logindex"), logs)
 
                 # Prepara a resposta de confirmação para o 'sendlog'.
                 # O dispositivo precisa desta confirmação para limpar os logs da sua memória interna.
                 response_dict = {
                     "ret": "sendlog",
-                    "result": success
+                    "result": resultado['sucesso'],
+                    "count": len(logs),
+                    "logindex": data.get("logindex")
                 }
                 ws.send(json.dumps(response_dict))
                 print(f"Enviado resposta 'sendlog': {json.dumps(response_dict)}")
 
+                # Lacuna detectada: pede os registros que faltam a partir do cursor.
+                if resultado['lacuna']:
+                    inicio, fim = resultado['lacuna']
+                    print(f"Lacuna nos logs do SN {sn}: índices {inicio} a {fim}")
+                    ws.send(json.dumps(comando_pedir_logs(inicio)))
+
+            # --- RESPOSTA DO EQUIPAMENTO A UM 'getlog' (PÁGINA DE SINCRONIZAÇÃO) ---
+            elif data.get("ret") == "getlog":
+                logs = data.get("record", [])
+                # A página é a resposta a um pedido a partir do cursor: se ainda começar depois dele,
+                # o equipamento não tem mais a lacuna, e pedir de novo repetiria a mesma página.
+                resultado = ingerir_logs_dispositivo(sn, data.get("logindex"), logs, aceitar_lacuna=True)
+
+                # Página cheia: provavelmente há mais registros, então pede a próxima.
+                # Sem logindex na resposta não há cursor para paginar (o equipamento envia o resto por 'sendlog').
+                if resultado['sucesso'] and len(logs) >= TAMANHO_PAGINA_LOGS and resultado['cursor'] is not None:
+                    ws.send(json.dumps(comando_pedir_logs(resultado['cursor'] + 1)))
+
         except Exception as e:
             # Se ocorrer um erro (ex: o cliente desconecta, JSON inválido), imprime o erro
             # e quebra o loop para fechar a conexão deste lado.
             print(f"Erro na conexão WebSocket: {e}")
             break
 
+# O decorador do Flask-Sock não devolve a função; registrando assim, evo_webhook
+# continua sendo uma função comum (chamada diretamente nos testes).
+sock.route('/api/v1/evo', bp=rotas)(evo_webhook)
+
+# --- Janela de Batidas Recentes (em memória, por processo) ---
+# Quase todo acesso ao dashboard olha só as últimas semanas. Cada processo (worker) guarda,
+# por fazenda, as batidas dos últimos DIAS_JANELA_RECENTE dias: elas são lidas do banco uma
+# vez e depois a janela só busca o que mudou ("tail"). Toda inserção e toda edição em registros
+# gravam a transação que as fez (registros.transacao, ver migração 9a0b1c2d3e4f), então uma única
+# consulta pelo cursor de transações (índice fazenda_id, transacao) traz tanto as batidas novas
+# quanto as justificativas editadas, venham elas deste processo, de outro worker ou dos equipamentos.
+#
+# O cursor é o de cursor_transacoes (a transação mais antiga ainda aberta), e não a maior versao
+# vista: uma importação ou um frame de equipamento ainda abertos podem ter pegado versões menores
+# e terminar depois. Cada busca traz as linhas com transacao >= cursor; as de transações que
+# terminaram depois do cursor são relidas na busca seguinte, e reaplicar uma batida já vista não
+# muda nada (a chave é o id). Uma transação muito longa segura o cursor (e as buscas relêem tudo
+# o que foi gravado desde ela), mas nenhuma batida fica de fora.
+#
+# A janela é organizada por dia: os dias que saem do período são descartados a cada atualização
+# e, se o total passar de MAX_BATIDAS_JANELA, os dias mais antigos também saem (o início da
+# janela avança). Períodos que começam antes do início da janela continuam sendo lidos do banco.
+# Cada batida ocupa algumas centenas de bytes na janela (100 mil batidas ≈ 30 MB por worker).
+
+# Quantidade de dias (contando hoje) guardados na janela.
+DIAS_JANELA_RECENTE = int(os.environ.get('RECENT_WINDOW_DAYS', '45'))
+# Limite de batidas guardadas na janela de cada fazenda.
+MAX_BATIDAS_JANELA = int(os.environ.get('RECENT_WINDOW_MAX_PUNCHES', '100000'))
+
+class JanelaRecente:
+    """
+    Batidas recentes de uma fazenda, em memória, agrupadas por dia.
+
+    - dias: {ordinal_do_dia: {id: (func_id, horario, origem, justificativa, id)}}
+    - inicio: primeiro instante coberto pela janela (None antes da primeira carga).
+    - transacao: cursor de transações da última atualização (ver cursor_transacoes).
+    """
+
+    def __init__(self, fazenda_id, dias=DIAS_JANELA_RECENTE, max_batidas=MAX_BATIDAS_JANELA):
+        self.fazenda_id = fazenda_id
+        self.quantidade_dias = dias
+        self.max_batidas = max_batidas
+        self.dias = {}
+        # Dia de cada id, para achar a batida quando ela é editada.
+        self._dia_do_id = {}
+        self.inicio = None
+        self.transacao = None
+        self.trava = threading.Lock()
+
+    def __len__(self):
+        return len(self._dia_do_id)
+
+    def limite(self, agora=None):
+        """Início nominal da janela: meia-noite de (hoje - dias + 1)."""
+        hoje = (agora or datetime.now()).date()
+        return datetime.combine(hoje - timedelta(days=self.quantidade_dias - 1), time(0, 0))
+
+    def cobre(self, inicio):
+        """Indica se um período que começa em 'inicio' pode ser atendido pela janela."""
+        return inicio is not None and inicio >= (self.inicio or self.limite())
+
+    def _aplicar(self, func_id, horario, origem, justificativa, id):
+        """Insere ou substitui uma batida (a chave é o id)."""
+        ordinal = horario.toordinal()
+        anterior = self._dia_do_id.get(id)
+        if anterior is not None and anterior != ordinal:
+            self.dias[anterior].pop(id, None)
+        self.dias.setdefault(ordinal, {})[id] = (func_id, horario, origem, justificativa, id)
+        self._dia_do_id[id] = ordinal
+
+    def _descartar_dias_antigos(self, limite):
+        """Remove os dias anteriores a 'limite' e, se passar do máximo, os mais antigos que sobrarem."""
+        for ordinal in sorted(self.dias):
+            if ordinal >= limite.toordinal() and len(self) <= self.max_batidas:
+                break
+            for id in self.dias.pop(ordinal):
+                del self._dia_do_id[id]
+            limite = max(limite, datetime.fromordinal(ordinal + 1))
+        self.inicio = limite
+
+    def atualizar(self, conn, agora=None):
+        """Carrega a janela (na primeira vez) ou aplica as batidas novas e editadas desde o cursor."""
+        with self.trava:
+            limite = max(self.limite(agora), self.inicio or datetime.min)
+            cur = conn.cursor()
+            # O cursor é lido antes dos dados: o que terminar depois dele vem na próxima busca.
+            transacao = cursor_transacoes(cur)
+            if self.transacao is None:
+                cur.close()
+                cur = conn.cursor(name='registros_janela')
+                cur.itersize = 5000
+                cur.execute("""
+                    SELECT func_id, horario, origem, justificativa, id FROM registros
+                    WHERE fazenda_id = %s AND horario >= %s
+                """, (self.fazenda_id, limite))
+            else:
+                cur.execute("""
+                    SELECT func_id, horario, origem, justificativa, id FROM registros
+                    WHERE fazenda_id = %s AND transacao >= %s::text::xid8 AND horario >= %s
+                """, (self.fazenda_id, self.transacao, limite))
+            for func_id, horario, origem, justificativa, id in cur:
+                self._aplicar(func_id, horario, origem, justificativa, id)
+            cur.close()
+            self.transacao = transacao
+            self._descartar_dias_antigos(limite)
+
+    def lote(self, inicio=None, fim=None, func_id=None):
+        """
+        Monta um LoteBatidas com as batidas da janela em [inicio, fim) (None = sem limite),
+        opcionalmente de um único funcionário.
+        """
+        primeiro = inicio.toordinal() if inicio else None
+        ultimo = fim.toordinal() if fim else None
+        lote = LoteBatidas()
+        with self.trava:
+            for ordinal in sorted(self.dias):
+                if (primeiro is not None and ordinal < primeiro) or (ultimo is not None and ordinal > ultimo):
+                    continue
+                for batida in self.dias[ordinal].values():
+                    horario = batida[1]
+                    if ((func_id is None or batida[0] == func_id)
+                            and (inicio is None or horario >= inicio) and (fim is None or horario < fim)):
+                        lote.adicionar(*batida)
+        return lote
+
+# Janelas de cada fazenda neste processo: {fazenda_id: JanelaRecente}.
+janelas_recentes = {}
+trava_janelas = threading.Lock()
+
+def janela_recente(fazenda_id):
+    """Retorna (criando, ainda vazia, na primeira vez) a janela de batidas recentes da fazenda."""
+    with trava_janelas:
+        janela = janelas_recentes.get(fazenda_id)
+        if janela is None:
+            janela = janelas_recentes[fazenda_id] = JanelaRecente(fazenda_id)
+        return janela
+
+def lote_recente(conn, fazenda_id, inicio, fim=None, func_id=None):
+    """
+    Batidas da fazenda em [inicio, fim) servidas pela janela em memória, que é atualizada
+    antes (uma consulta pequena, pelo cursor de transações). Retorna None se o período começa
+    antes da janela; nesse caso quem chamou lê os registros do banco.
+    """
+    janela = janela_recente(fazenda_id)
+    if not janela.cobre(inicio):
+        return None
+    janela.atualizar(conn)
+    # A atualização pode ter avançado o início da janela (limite de tamanho).
+    if not janela.cobre(inicio):
+        return None
+    return janela.lote(inicio, fim, func_id)
+
 # --- Rota Principal da Aplicação ---
 
-@app.route('/')
+@rotas.route('/')
 def index():
-    """Rota principal que exibe o dashboard com todos os dados."""
+    """Rota principal que exibe o dashboard com todos os dados da fazenda selecionada."""
     # Verifica se o usuário está logado (verificando a sessão). Se não, redireciona para a página de login.
     if not session.get('logged_in'):
-        return redirect(url_for('login'))
+        return redirect(url_for('ponto.login'))
 
-    registros_brutos_completo = []
+    fazenda = fazenda_atual()
+    # Por padrão o dashboard mostra os últimos DIAS_JANELA_RECENTE dias; ?historico=1 mostra tudo.
+    desde = None if request.args.get('historico') == '1' else janela_recente(fazenda.id).limite()
+    lote = LoteBatidas()
     last_evo_comm = None
+    # Relatórios calculados no banco (motor SQL); os que ficarem None usam o motor Python.
+    pontos_faltantes = resumo_horas = None
     try:
         # Bloco principal: tenta conectar ao banco de dados e buscar os registros.
         conn = get_db_connection()
         cur = conn.cursor()
 
-        # Busca a última comunicação de qualquer dispositivo EVO.
-        cur.execute("SELECT MAX(last_communication) FROM dispositivos")
+        # Busca a última comunicação dos dispositivos EVO da fazenda (os não vinculados contam na padrão).
+        cur.execute("SELECT MAX(last_communication) FROM dispositivos WHERE COALESCE(fazenda_id, %s) = %s",
+                    (FAZENDA_PADRAO, fazenda.id))
         row = cur.fetchone()
         if row:
             last_evo_comm = row[0]
 
-        # Busca id, func_id, horario, origem e justificativa.
-        cur.execute("SELECT func_id, horario, origem, justificativa, id FROM registros ORDER BY horario DESC")
-        registros_brutos_completo = cur.fetchall() # Pega todos os resultados da consulta.
         cur.close()
+
+        # As batidas dos últimos dias vêm da janela em memória (só as novas e editadas são lidas).
+        # Se a janela não cobrir o período, ou com ?historico=1, elas são lidas do banco.
+        lote_janela = lote_recente(conn, fazenda.id, desde) if desde else None
+        if lote_janela is not None:
+            lote = lote_janela
+        else:
+            # Busca id, func_id, horario, origem e justificativa das batidas da fazenda.
+            # Usa um cursor nomeado (do lado do servidor): as linhas chegam em blocos e vão
+            # direto para os arrays do LoteBatidas, sem montar uma lista com todas as tuplas.
+            filtro, parametros = filtro_periodo(desde, fazenda_id=fazenda.id)
+            cur = conn.cursor(name='registros_dashboard')
+            cur.itersize = 5000
+            cur.execute(f"""
+                SELECT func_id, horario, origem, justificativa, id FROM registros
+                WHERE {filtro} ORDER BY horario DESC
+            """, parametros)
+            lote = LoteBatidas.do_cursor(cur)
+            cur.close()
+
+        if motor_do_relatorio('faltantes') == 'sql':
+            pontos_faltantes = processar_pontos_faltantes_sql(conn, fazenda.funcionarios, desde, fazenda_id=fazenda.id,
+                                                              ibge_code=fazenda.ibge_code)
+        if motor_do_relatorio('horas') == 'sql':
+            resumo_horas = calcular_horas_trabalhadas_sql(conn, fazenda.funcionarios, desde, fazenda_id=fazenda.id,
+                                                          ibge_code=fazenda.ibge_code)
         conn.close()
     except Exception as e:
         # Bloco de exceção: executado se a conexão com o banco de dados falhar.
@@ -508,53 +1633,57 @@ def index():
             ('2', datetime.combine(segunda_feira_passada + timedelta(days=5), time(7, 0)), 'equipamento', None, 208), # Sábado (esqueceu de bater a saída)
             ('2', datetime.combine(segunda_feira_passada + timedelta(days=5), time(13, 0)), 'equipamento', None, 209), # Esta batida será ignorada
         ]
+        lote = LoteBatidas.de_tuplas(registros_brutos_completo)
 
     # --- Processamento dos Dados ---
     # Independentemente de os dados virem do banco ou serem fictícios, eles são processados aqui.
 
-    # Extrai apenas (func_id, horario) para as funções de processamento legadas.
-    registros_para_processar = [(r[0], r[1]) for r in registros_brutos_completo]
-
     # Chama a função para encontrar pontos faltantes.
-    pontos_faltantes = processar_pontos_faltantes(registros_para_processar, funcionarios)
+    if pontos_faltantes is None:
+        pontos_faltantes = processar_pontos_faltantes(lote, fazenda.funcionarios, fazenda.ibge_code)
     # Chama a função para calcular as horas trabalhadas.
-    resumo_horas = calcular_horas_trabalhadas(registros_para_processar, funcionarios)
-
-    # Mapeia os dados para um formato de dicionário mais fácil de usar no template.
-    dados_mapeados = sorted(
-        [{
-            'id': r[4],
-            'nome': funcionarios.get(str(r[0]), "Desconhecido"),
-            'func_id': r[0],
-            'horario': r[1],
-            'origem': r[2],
-            'justificativa': r[3]
-        } for r in registros_brutos_completo],
-        key=lambda x: x['horario'],
-        reverse=True
-    )
-
-    # Busca os feriados do ano atual para exibir no calendário.
+    if resumo_horas is None:
+        resumo_horas = calcular_horas_trabalhadas(lote, fazenda.funcionarios, fazenda.ibge_code)
+
+    # Mapeia os dados para um formato de dicionário mais fácil de usar no template
+    # (do mais recente para o mais antigo).
+    dados_mapeados = []
+    for i in lote.ordem_decrescente():
+        func_id, horario, origem, justificativa, id = lote.linha(i)
+        dados_mapeados.append({
+            'id': id,
+            'nome': fazenda.funcionarios.get(func_id, "Desconhecido"),
+            'func_id': func_id,
+            'horario': horario,
+            'origem': origem,
+            'justificativa': justificativa
+        })
+
+    # Busca os feriados do ano atual (a partir do índice de calendário) para exibir no calendário.
     ano_atual = datetime.now().year
-    feriados = get_feriados(ano_atual)
+    feriados = get_calendario(ano_atual, fazenda.ibge_code).feriados
 
     # Renderiza o template 'index.html', passando todas as informações processadas para ele.
     return render_template('index.html',
                            pontos=dados_mapeados,
                            pontos_faltantes=pontos_faltantes,
                            resumo_horas=resumo_horas,
-                           funcionarios=funcionarios,
+                           funcionarios=fazenda.funcionarios,
+                           fazenda=fazenda,
+                           fazendas=obter_fazendas(),
                            feriados=feriados,
                            last_evo_comm=last_evo_comm,
+                           desde=desde,
                            now=datetime.now())
 
 # --- Rota para Recebimento de Dados do Relógio ---
 
-@app.route('/iclock/cdata', methods=['POST', 'GET'])
+@rotas.route('/iclock/cdata', methods=['POST', 'GET'])
 def receber_ponto():
     """
     Esta é a rota que o relógio de ponto (ZKTeco) acessa para enviar os dados.
-    Ela recebe os dados, processa e insere no banco de dados.
+    Ela recebe os dados, processa e insere no banco de dados, na fazenda do relógio
+    (o número de série vem no parâmetro 'SN' da URL).
     """
     # O equipamento envia os dados no corpo da requisição em formato de texto.
     raw_data = request.get_data(as_text=True)
@@ -564,10 +1693,12 @@ def receber_ponto():
     try:
         conn = get_db_connection()
         cur = conn.cursor()
+        fazenda_id = fazenda_do_dispositivo(cur, request.args.get('SN'))
 
         # Os dados podem vir com múltiplas linhas, cada uma sendo um registro.
         # Elas são separadas por '\r\n'.
         lines = raw_data.strip().split('\r\n')
+        gravadas = []
         for line in lines:
             # Cada linha tem colunas separadas por uma tabulação ('\t').
             parts = line.split('\t')
@@ -582,10 +1713,12 @@ def receber_ponto():
 
                 # Executa o comando SQL para inserir o novo registro na tabela.
                 # Usar '%s' ajuda a prevenir ataques de "SQL Injection".
-                cur.execute("INSERT INTO registros (func_id, horario, origem) VALUES (%s, %s, %s)",
-                            (func_id, horario, 'equipamento'))
+                cur.execute("INSERT INTO registros (fazenda_id, func_id, horario, origem) VALUES (%s, %s, %s, %s)",
+                            (fazenda_id, func_id, horario, 'equipamento'))
+                gravadas.append((func_id, horario))
         # Salva todas as inserções feitas no loop.
         conn.commit()
+        invalidar_resumos(gravadas, fazenda_id)
         cur.close()
         conn.close()
         # O relógio espera uma resposta "OK" para saber que os dados foram recebidos.
@@ -597,23 +1730,38 @@ def receber_ponto():
 
 # --- Rota para Exportação de Dados ---
 
-@app.route('/export')
+@rotas.route('/export')
 def export_excel():
     """
-    Busca todos os registros do banco de dados e os exporta como um arquivo Excel.
+    Busca todos os registros da fazenda selecionada e os exporta como um arquivo Excel.
     Inclui as novas colunas de origem e justificativa.
+    Com ?formato=parquet, exporta em Parquet (veja exportar_parquet_zip).
     """
     # Protege a rota, exigindo que o usuário esteja logado.
     if not session.get('logged_in'):
-        return redirect(url_for('login'))
+        return redirect(url_for('ponto.login'))
+    if request.args.get('formato') == 'parquet':
+        return exportar_parquet_zip()
+    # pandas: Usado apenas aqui para montar o Excel, por isso é importado sob demanda.
+    import pandas as pd
+
+    fazenda = fazenda_atual()
     try:
         conn = get_db_connection()
-        # Usa o pandas para executar a consulta SQL e carregar os resultados diretamente em um DataFrame.
-        df = pd.read_sql_query("SELECT func_id, horario, origem, justificativa FROM registros ORDER BY horario DESC", conn)
+        # Carrega os registros em um LoteBatidas (arrays compactos, via cursor nomeado)
+        # e converte as colunas diretamente para um DataFrame do pandas.
+        cur = conn.cursor(name='registros_export')
+        cur.itersize = 5000
+        cur.execute("""
+            SELECT func_id, horario, origem, justificativa, id FROM registros
+            WHERE fazenda_id = %s ORDER BY horario DESC
+        """, (fazenda.id,))
+        df = LoteBatidas.do_cursor(cur).para_dataframe()
+        cur.close()
         conn.close()
 
         # Usa o método '.map()' do pandas para trocar os IDs dos funcionários pelos seus nomes.
-        df['func_id'] = df['func_id'].map(funcionarios).fillna(df['func_id'])
+        df['func_id'] = df['func_id'].map(fazenda.funcionarios).fillna(df['func_id'])
         # Renomeia as colunas para ficarem mais apresentáveis no Excel.
         df.rename(columns={
             'func_id': 'Funcionário',
@@ -644,20 +1792,624 @@ def export_excel():
     except Exception as e:
         return f"Erro ao exportar dados: {e}"
 
+# --- Espelhos de Ponto Mensais (em lote, como ZIP) ---
+
+# Abreviações dos dias da semana, na ordem de date.weekday().
+DIAS_SEMANA = ('Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sáb', 'Dom')
+
+def carregar_lote_periodo(conn, inicio, fim, fazenda_id=FAZENDA_PADRAO):
+    """
+    Carrega em um LoteBatidas os registros da fazenda com horario em [inicio, fim),
+    usando um cursor nomeado (as linhas vêm do banco em blocos).
+    """
+    cur = conn.cursor(name='registros_periodo')
+    cur.itersize = 5000
+    cur.execute("""
+        SELECT func_id, horario, origem, justificativa, id FROM registros
+        WHERE fazenda_id = %s AND horario >= %s AND horario < %s
+        ORDER BY horario
+    """, (fazenda_id, inicio, fim))
+    lote = LoteBatidas.do_cursor(cur)
+    cur.close()
+    return lote
+
+def montar_espelhos(lote, funcionarios_map, ano, mes, ibge_code=IBGE_PADRAO):
+    """
+    Monta os dados do espelho de ponto de cada funcionário para o mês informado.
+
+    Cada espelho tem uma linha por dia do mês, com as batidas (e suas justificativas),
+    o feriado do dia (se houver) e as horas normal/extra50/extra100, além dos totais.
+    Usa as mesmas regras de calcular_horas_trabalhadas.
+
+    Returns:
+        list: Uma lista de dicionários (um por funcionário), ordenada pelo ID.
+    """
+    primeiro_dia = date(ano, mes, 1)
+    ultimo_dia = (date(ano + mes // 12, mes % 12 + 1, 1) - timedelta(days=1))
+    calendario = get_calendario(ano, ibge_code)
+
+    # Posições das batidas de cada funcionário, em ordem cronológica.
+    posicoes = {func_id: [] for func_id in funcionarios_map}
+    for i in sorted(range(len(lote)), key=lote.horarios.__getitem__):
+        posicoes.setdefault(lote.func_ids[lote.funcionarios[i]], []).append(i)
+
+    espelhos = []
+    for func_id in sorted(posicoes):
+        # Agrupa as posições por dia (ordinal).
+        por_dia = {}
+        for i in posicoes[func_id]:
+            por_dia.setdefault(lote.horarios[i] // SEGUNDOS_POR_DIA + ORDINAL_EPOCA, []).append(i)
+
+        dias = []
+        totais = {'trabalhado': 0, 'normal': 0, 'extra50': 0, 'extra100': 0}
+        for ordinal in range(primeiro_dia.toordinal(), ultimo_dia.toordinal() + 1):
+            data = date.fromordinal(ordinal)
+            indice = ordinal - calendario.inicio
+            batidas_dia = por_dia.get(ordinal, [])
+
+            trabalhado = horas_trabalhadas_dia([lote.horarios[i] for i in batidas_dia])
+            normal, extra50, extra100 = dividir_horas_dia(trabalhado, calendario.limites[indice])
+            for tipo, segundos in (('trabalhado', trabalhado), ('normal', normal),
+                                   ('extra50', extra50), ('extra100', extra100)):
+                totais[tipo] += segundos
+
+            dias.append({
+                'data': data.strftime('%d/%m/%Y'),
+                'dia_semana': DIAS_SEMANA[data.weekday()],
+                'feriado': calendario.feriados.get(data.isoformat()),
+                'fim_de_semana': calendario.tipos[indice] & MASCARA_DIA_SEMANA != DIA_UTIL,
+                'batidas': [{
+                    'hora': lote.horario(i).strftime('%H:%M'),
+                    'manual': ORIGENS[lote.origens[i]] == 'manual',
+                    'justificativa': lote.justificativas.get(i),
+                } for i in batidas_dia],
+                'trabalhado': formatar_duracao(trabalhado) if batidas_dia else '',
+                'normal': formatar_duracao(normal) if normal else '',
+                'extra50': formatar_duracao(extra50) if extra50 else '',
+                'extra100': formatar_duracao(extra100) if extra100 else '',
+            })
+
+        espelhos.append({
+            'func_id': func_id,
+            'nome': funcionarios_map.get(func_id, "Desconhecido"),
+            'periodo': primeiro_dia.strftime('%m/%Y'),
+            'dias': dias,
+            'totais': {tipo: formatar_duracao(segundos) for tipo, segundos in totais.items()},
+        })
+    return espelhos
+
+class SaidaZipStreaming:
+    """
+    Arquivo "de mentira" onde o zipfile escreve. Os bytes ficam guardados até serem
+    retirados, o que permite enviar o ZIP ao navegador aos pedaços (streaming).
+    Como não tem tell()/seek(), o zipfile grava o ZIP no modo sequencial.
+    """
+
+    def __init__(self):
+        self.partes = []
+
+    def write(self, dados):
+        self.partes.append(bytes(dados))
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def retirar(self):
+        dados = b''.join(self.partes)
+        self.partes.clear()
+        return dados
+
+def gerar_zip_espelhos(espelhos, template):
+    """
+    Renderiza os espelhos um a um (com o template já compilado) e gera o ZIP em
+    pedaços de bytes, um pedaço por espelho, na ordem da lista.
+
+    A renderização do Jinja é trabalho de CPU em Python puro: threads não rodam em
+    paralelo por causa do GIL, e um pool de processos por requisição custaria mais
+    do que renderizar (e não funciona em ambientes serverless como a Vercel). Assim,
+    cada espelho é renderizado só quando o pedaço anterior já foi enviado.
+    """
+    saida = SaidaZipStreaming()
+    with zipfile.ZipFile(saida, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for espelho in espelhos:
+            nome_arquivo = f"espelho_{espelho['func_id']}_{espelho['periodo'].replace('/', '-')}.html"
+            zf.writestr(nome_arquivo, template.render(espelho=espelho))
+            yield saida.retirar()
+    # O fechamento do ZIP grava o índice central (o "sumário" do arquivo).
+    yield saida.retirar()
+
+@rotas.route('/espelhos')
+def exportar_espelhos():
+    """
+    Gera os espelhos de ponto de todos os funcionários para um mês (parâmetro 'mes'
+    no formato AAAA-MM; o padrão é o mês atual) da fazenda selecionada e envia tudo em
+    um único arquivo ZIP. Os registros do mês são carregados do banco uma única vez.
+    """
+    if not session.get('logged_in'):
+        return redirect(url_for('ponto.login'))
+
+    try:
+        mes_param = request.args.get('mes') or datetime.now().strftime('%Y-%m')
+        inicio = datetime.strptime(mes_param, '%Y-%m')
+    except ValueError:
+        return "Mês inválido (use AAAA-MM)", 400
+    fim = datetime(inicio.year + inicio.month // 12, inicio.month % 12 + 1, 1)
+
+    fazenda = fazenda_atual()
+    try:
+        conn = get_db_connection()
+        # O mês atual (e o anterior, se couber na janela) sai da janela em memória.
+        lote = lote_recente(conn, fazenda.id, inicio, fim)
+        if lote is None:
+            lote = carregar_lote_periodo(conn, inicio, fim, fazenda.id)
+        conn.close()
+    except Exception as e:
+        return f"Erro ao gerar espelhos de ponto: {e}"
+
+    espelhos = montar_espelhos(lote, fazenda.funcionarios, inicio.year, inicio.month, fazenda.ibge_code)
+    for espelho in espelhos:
+        espelho['fazenda'] = fazenda.nome
+    # O template é compilado uma vez aqui e reaproveitado por todos os espelhos.
+    template = current_app.jinja_env.get_template('espelho_ponto.html')
+
+    response = Response(gerar_zip_espelhos(espelhos, template), mimetype='application/zip')
+    response.headers["Content-Disposition"] = f"attachment; filename=espelhos_ponto_{mes_param}.zip"
+    return response
+
+# --- Exportação Colunar (Parquet) para Análises ---
+# Alternativa ao Excel para as rotinas de BI: os registros e um resumo diário por
+# funcionário são gravados em arquivos Parquet (colunas tipadas, comprimidos com zstd),
+# particionados por mês no formato "hive":
+#   registros/mes=2024-05/dados.parquet
+#   resumo_diario/mes=2024-05/dados.parquet
+#   _exportacao.json  (cursor da exportação)
+# Assim o pyarrow/pandas/DuckDB lê só as colunas e os meses necessários.
+#
+# Modo incremental: o cursor é a transação mais antiga ainda aberta no início da exportação
+# (ver cursor_transacoes). Com 'desde=<cursor>', só os meses que tiveram registros gravados
+# por transações a partir daquela são exportados, sempre completos: cada partição nova
+# substitui a antiga. Cada exportação é de uma fazenda (a selecionada no dashboard ou a do
+# --fazenda no comando).
+
+# Tipos dos dias no resumo diário, na ordem dos valores de DIA_UTIL/DIA_SABADO/DIA_DOMINGO.
+TIPOS_DIA = ('util', 'sabado', 'domingo')
+
+def cursor_transacoes(cur):
+    """
+    Cursor seguro para leituras incrementais de registros: o id da transação mais antiga
+    ainda aberta (pg_snapshot_xmin). Toda transação com id menor já terminou, então as
+    linhas gravadas por ela já estão visíveis e nenhuma outra vai aparecer com id menor.
+
+    Um cursor como MAX(versao) não serve: a versao é distribuída antes do COMMIT, e uma
+    transação aberta (um frame de equipamento, uma importação) que pegou versões menores
+    pode terminar depois da leitura do cursor, ficando para trás para sempre.
+
+    A leitura seguinte pega as linhas com registros.transacao >= cursor. Transações que já
+    tinham terminado entre o cursor e a leitura aparecem de novo na próxima vez; por isso
+    quem usa o cursor precisa aceitar reprocessar linhas (as partições e a janela são
+    substituídas/atualizadas pelo id, não acumuladas).
+    """
+    cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+    return cur.fetchone()[0]
+
+def meses_para_exportar(conn, desde=None, fazenda_id=FAZENDA_PADRAO):
+    """
+    Descobre quais meses exportar e o cursor da exportação.
+
+    Args:
+        conn: Conexão com o banco.
+        desde (int | None): Cursor de uma exportação anterior (None = exporta tudo).
+        fazenda_id (int): A fazenda exportada.
+
+    Returns:
+        tuple: (meses, cursor), com os meses como datetime do dia 1, em ordem.
+    """
+    cur = conn.cursor()
+    # O cursor é lido antes dos dados: o que mudar durante a exportação sai de novo na próxima.
+    cursor = cursor_transacoes(cur)
+    if desde is None:
+        cur.execute("""
+            SELECT DISTINCT date_trunc('month', horario) FROM registros
+            WHERE fazenda_id = %s ORDER BY 1
+        """, (fazenda_id,))
+    else:
+        cur.execute("""
+            SELECT DISTINCT date_trunc('month', horario) FROM registros
+            WHERE fazenda_id = %s AND transacao >= %s::text::xid8 ORDER BY 1
+        """, (fazenda_id, desde))
+    meses = [row[0] for row in cur.fetchall()]
+    cur.close()
+    return meses, cursor
+
+def tabela_registros_arrow(lote, funcionarios_map):
+    """Converte um LoteBatidas para uma tabela do Arrow, direto dos arrays do lote."""
+    import numpy as np
+    import pyarrow as pa
+
+    # func_id e origem viram colunas "dicionário": cada valor distinto é gravado uma vez só.
+    indices_func = pa.array(np.asarray(lote.funcionarios, dtype=np.int32))
+    nomes = [funcionarios_map.get(func_id, "Desconhecido") for func_id in lote.func_ids]
+    horarios = np.asarray(lote.horarios, dtype=np.int64)
+    justificativas = [None] * len(lote)
+    for i, texto in lote.justificativas.items():
+        justificativas[i] = texto
+
+    return pa.table({
+        'id': pa.array(np.asarray(lote.ids, dtype=np.int64)),
+        'func_id': pa.DictionaryArray.from_arrays(indices_func, pa.array(lote.func_ids, pa.string())),
+        'nome': pa.DictionaryArray.from_arrays(indices_func, pa.array(nomes, pa.string())),
+        'horario': pa.array(horarios, type=pa.timestamp('s')),
+        'data': pa.array((horarios // SEGUNDOS_POR_DIA).astype(np.int32), type=pa.date32()),
+        'origem': pa.DictionaryArray.from_arrays(pa.array(np.asarray(lote.origens, dtype=np.int8)),
+                                                 pa.array(ORIGENS, pa.string())),
+        'justificativa': pa.array(justificativas, pa.string()),
+    })
+
+def tabela_resumo_diario_arrow(lote, funcionarios_map, ibge_code=IBGE_PADRAO):
+    """
+    Monta uma tabela do Arrow com uma linha por funcionário e dia trabalhado, com as
+    mesmas regras de calcular_horas_trabalhadas (tempos em segundos).
+    """
+    import pyarrow as pa
+
+    colunas = {nome: [] for nome in ('func_id', 'nome', 'data', 'tipo_dia', 'feriado', 'batidas',
+                                     'batida_impar', 'trabalhado_s', 'normal_s', 'extra50_s', 'extra100_s')}
+    calendario = None
+    for func_id, horarios in lote.por_funcionario():
+        for ordinal, registros_dia in agrupar_por_dia(horarios):
+            calendario = calendario_do_ordinal(ordinal, calendario, ibge_code)
+            indice = ordinal - calendario.inicio
+            data = date.fromordinal(ordinal)
+            trabalhado = horas_trabalhadas_dia(registros_dia)
+            normal, extra50, extra100 = dividir_horas_dia(trabalhado, calendario.limites[indice])
+
+            colunas['func_id'].append(func_id)
+            colunas['nome'].append(funcionarios_map.get(func_id, "Desconhecido"))
+            colunas['data'].append(data)
+            colunas['tipo_dia'].append(TIPOS_DIA[calendario.tipos[indice] & MASCARA_DIA_SEMANA])
+            colunas['feriado'].append(calendario.feriados.get(data.isoformat()))
+            colunas['batidas'].append(len(registros_dia))
+            colunas['batida_impar'].append(len(registros_dia) % 2 != 0)
+            colunas['trabalhado_s'].append(trabalhado)
+            colunas['normal_s'].append(normal)
+            colunas['extra50_s'].append(extra50)
+            colunas['extra100_s'].append(extra100)
+
+    tipos = {
+        'func_id': pa.string(), 'nome': pa.string(), 'data': pa.date32(), 'tipo_dia': pa.string(),
+        'feriado': pa.string(), 'batidas': pa.int16(), 'batida_impar': pa.bool_(),
+        'trabalhado_s': pa.int32(), 'normal_s': pa.int32(), 'extra50_s': pa.int32(), 'extra100_s': pa.int32(),
+    }
+    tabela = pa.table({nome: pa.array(valores, tipos[nome]) for nome, valores in colunas.items()})
+    # Colunas com poucos valores distintos ficam como dicionário.
+    for nome in ('func_id', 'nome', 'tipo_dia'):
+        tabela = tabela.set_column(tabela.schema.get_field_index(nome), nome,
+                                   tabela[nome].dictionary_encode())
+    return tabela
+
+def parquet_em_bytes(tabela):
+    """Grava a tabela em Parquet (zstd) e retorna os bytes do arquivo."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    saida = pa.BufferOutputStream()
+    pq.write_table(tabela, saida, compression='zstd')
+    return saida.getvalue().to_pybytes()
+
+def arquivos_parquet(conn, meses, cursor, desde, fazenda):
+    """
+    Gera (caminho, bytes) de cada arquivo da exportação da fazenda, um mês por vez (só os
+    registros de um mês ficam na memória). O último arquivo é o _exportacao.json.
+    """
+    for mes in meses:
+        fim = datetime(mes.year + mes.month // 12, mes.month % 12 + 1, 1)
+        lote = carregar_lote_periodo(conn, mes, fim, fazenda.id)
+        particao = f"mes={mes:%Y-%m}"
+        yield f"registros/{particao}/dados.parquet", parquet_em_bytes(tabela_registros_arrow(lote, fazenda.funcionarios))
+        yield (f"resumo_diario/{particao}/dados.parquet",
+               parquet_em_bytes(tabela_resumo_diario_arrow(lote, fazenda.funcionarios, fazenda.ibge_code)))
+
+    info = {
+        'fazenda': fazenda.id,
+        'cursor': cursor,
+        'desde': desde,
+        'meses': [f"{mes:%Y-%m}" for mes in meses],
+        'exportado_em': datetime.now().isoformat(timespec='seconds'),
+    }
+    yield "_exportacao.json", json.dumps(info, indent=2).encode('utf-8')
+
+def exportar_parquet_zip():
+    """
+    Exporta os registros e o resumo diário da fazenda selecionada em Parquet, dentro de um ZIP
+    enviado aos pedaços. Parâmetro opcional 'desde': cursor de uma exportação anterior (modo incremental).
+    O cursor desta exportação vai no cabeçalho X-Export-Cursor e no _exportacao.json.
+    """
+    desde = request.args.get('desde')
+    if desde is not None:
+        if not desde.isdigit():
+            return "Cursor inválido (use o número de X-Export-Cursor)", 400
+        desde = int(desde)
+
+    fazenda = fazenda_atual()
+    conn = None
+    try:
+        conn = get_db_connection()
+        meses, cursor = meses_para_exportar(conn, desde, fazenda.id)
+    except Exception as e:
+        return f"Erro ao exportar dados: {e}"
+    finally:
+        if conn:
+            conn.close()
+
+    def gerar():
+        # A conexão dos dados é aberta só quando o envio começa: se o cliente desistir antes
+        # do primeiro pedaço, o gerador nunca roda e não há conexão para fechar.
+        conn = get_db_connection()
+        saida = SaidaZipStreaming()
+        try:
+            # Os arquivos Parquet já são comprimidos, então o ZIP só os armazena.
+            with zipfile.ZipFile(saida, 'w', compression=zipfile.ZIP_STORED) as zf:
+                for caminho, dados in arquivos_parquet(conn, meses, cursor, desde, fazenda):
+                    zf.writestr(caminho, dados)
+                    yield saida.retirar()
+            yield saida.retirar()
+        finally:
+            conn.close()
+
+    response = Response(gerar(), mimetype='application/zip')
+    response.headers["Content-Disposition"] = (
+        f"attachment; filename=registros_ponto_parquet_{fazenda.id}_{cursor}.zip")
+    response.headers["X-Export-Cursor"] = str(cursor)
+    return response
+
+@click.command('exportar-parquet')
+@click.argument('destino')
+@click.option('--incremental', is_flag=True,
+              help='Exporta só os meses alterados desde a última exportação para este destino.')
+@click.option('--fazenda', 'fazenda_id', default=FAZENDA_PADRAO, help='ID da fazenda exportada.')
+def comando_exportar_parquet(destino, incremental, fazenda_id):
+    """Grava a exportação Parquet de uma fazenda em um diretório (ex: uma pasta sincronizada com o BI)."""
+    fazenda = obter_fazendas().get(fazenda_id)
+    if fazenda is None:
+        raise click.ClickException(f"Fazenda {fazenda_id} não encontrada.")
+    desde = None
+    caminho_info = os.path.join(destino, '_exportacao.json')
+    if incremental and os.path.exists(caminho_info):
+        with open(caminho_info, encoding='utf-8') as f:
+            info = json.load(f)
+        # O cursor de outra fazenda não serve: nesse caso exporta tudo de novo.
+        if info.get('fazenda', FAZENDA_PADRAO) == fazenda.id:
+            desde = info['cursor']
+
+    conn = get_db_connection()
+    try:
+        meses, cursor = meses_para_exportar(conn, desde, fazenda.id)
+        for caminho, dados in arquivos_parquet(conn, meses, cursor, desde, fazenda):
+            completo = os.path.join(destino, *caminho.split('/'))
+            os.makedirs(os.path.dirname(completo), exist_ok=True)
+            # Grava em um temporário e renomeia: quem estiver lendo nunca vê um arquivo pela metade.
+            temporario = f"{completo}.tmp"
+            with open(temporario, 'wb') as f:
+                f.write(dados)
+            os.replace(temporario, completo)
+    finally:
+        conn.close()
+    print(f"Exportação Parquet concluída em {destino}: {len(meses)} mês(es), cursor {cursor}.")
+
+# --- Resumo do Funcionário (Autoatendimento, com Cache) ---
+# Cada funcionário consulta o próprio mês: batidas, batidas faltantes e horas
+# normal/extra50/extra100. Só as batidas daquele funcionário naquele mês são lidas do banco,
+# e o resultado fica em cache por (fazenda, funcionário, mês). Toda gravação de batidas (equipamentos,
+# ponto manual, importação) e toda edição de justificativa invalida as entradas afetadas.
+# Na troca de turno, quando dezenas de funcionários consultam ao mesmo tempo, pedidos iguais
+# esperam o primeiro cálculo em vez de repetir a consulta.
+#
+# O cache é de cada processo (worker): a invalidação só alcança o processo que fez a gravação,
+# por isso as entradas também expiram depois de TTL_RESUMO_FUNCIONARIO segundos.
+#
+# O funcionário acessa pelo link pessoal (com um token assinado que também identifica a
+# fazenda, já que o mesmo func_id existe em várias fazendas), gerado com:
+#   flask --app app link-funcionario 1 --fazenda 1
+# O link não exige login, então o token é assinado com a chave secreta da variável de
+# ambiente SECRET_KEY (nunca com um valor do código) e vale por EMPLOYEE_LINK_MAX_AGE_DAYS dias.
+# Sem SECRET_KEY, nenhum link é gerado nem aceito.
+
+# Tempo máximo (em segundos) que um resumo fica no cache.
+TTL_RESUMO_FUNCIONARIO = int(os.environ.get('EMPLOYEE_SUMMARY_TTL', '60'))
+# Validade (em dias) dos links pessoais.
+VALIDADE_LINK_FUNCIONARIO_DIAS = int(os.environ.get('EMPLOYEE_LINK_MAX_AGE_DAYS', '90'))
+
+# Resumos em cache: {(fazenda_id, func_id, ano, mes): (expira_em, resumo)}.
+cache_resumos = {}
+# Cálculos em andamento: {chave: {'trava', 'usuarios', 'geracao'}}. A trava faz pedidos
+# simultâneos do mesmo resumo esperarem um único cálculo; a geração aumenta a cada invalidação,
+# para descartar um cálculo que começou antes dela. A entrada sai quando o último pedido termina.
+calculos_resumos = {}
+trava_cache_resumos = threading.Lock()
+
+def invalidar_resumos(batidas, fazenda_id=FAZENDA_PADRAO):
+    """Remove do cache os resumos afetados pelas batidas (func_id, horario) gravadas ou editadas na fazenda."""
+    chaves = {(fazenda_id, str(func_id), horario.year, horario.month) for func_id, horario in batidas}
+    with trava_cache_resumos:
+        for chave in chaves:
+            cache_resumos.pop(chave, None)
+            calculo = calculos_resumos.get(chave)
+            if calculo:
+                calculo['geracao'] += 1
+
+def calcular_resumo_funcionario(fazenda_id, func_id, ano, mes):
+    """Lê as batidas do funcionário no mês e calcula o resumo (mesmas regras do dashboard)."""
+    fazenda = obter_fazendas().get(fazenda_id) or fazendas_sem_banco()[FAZENDA_PADRAO]
+    inicio = datetime(ano, mes, 1)
+    fim = datetime(ano + mes // 12, mes % 12 + 1, 1)
+    conn = get_db_connection()
+    try:
+        # Meses recentes saem da janela em memória; os antigos, do banco.
+        lote = lote_recente(conn, fazenda_id, inicio, fim, func_id)
+        if lote is None:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT func_id, horario, origem, justificativa, id FROM registros
+                WHERE fazenda_id = %s AND func_id = %s AND horario >= %s AND horario < %s
+                ORDER BY horario
+            """, (fazenda_id, func_id, inicio, fim))
+            lote = LoteBatidas.do_cursor(cur)
+            cur.close()
+    finally:
+        conn.close()
+
+    nome = fazenda.funcionarios.get(func_id, "Desconhecido")
+    return {
+        'fazenda_id': fazenda_id,
+        'func_id': func_id,
+        'nome': nome,
+        'periodo': inicio.strftime('%Y-%m'),
+        'batidas': [{'id': id, 'horario': horario.isoformat(), 'origem': origem, 'justificativa': justificativa}
+                    for _, horario, origem, justificativa, id in lote],
+        'faltantes': [{'data': f['data'], 'horario_faltante': f['horario_faltante']}
+                      for f in processar_pontos_faltantes(lote, {func_id: nome}, fazenda.ibge_code)],
+        'horas': calcular_horas_trabalhadas(lote, {func_id: nome}, fazenda.ibge_code)[nome],
+        'gerado_em': datetime.now().isoformat(timespec='seconds'),
+    }
+
+def obter_resumo_funcionario(func_id, ano, mes, fazenda_id=FAZENDA_PADRAO):
+    """
+    Retorna o resumo do funcionário da fazenda no mês, do cache quando possível.
+
+    Returns:
+        tuple: (resumo, veio_do_cache)
+    """
+    chave = (fazenda_id, str(func_id), ano, mes)
+    with trava_cache_resumos:
+        entrada = cache_resumos.get(chave)
+        if entrada and entrada[0] > monotonic():
+            return entrada[1], True
+        calculo = calculos_resumos.setdefault(chave, {'trava': threading.Lock(), 'usuarios': 0, 'geracao': 0})
+        calculo['usuarios'] += 1
+
+    try:
+        with calculo['trava']:
+            # Outro pedido pode ter calculado o resumo enquanto este esperava a trava.
+            with trava_cache_resumos:
+                entrada = cache_resumos.get(chave)
+                if entrada and entrada[0] > monotonic():
+                    return entrada[1], True
+                geracao = calculo['geracao']
+
+            resumo = calcular_resumo_funcionario(*chave)
+
+            with trava_cache_resumos:
+                # Só guarda se nenhuma gravação invalidou a chave durante o cálculo.
+                if calculo['geracao'] == geracao:
+                    agora = monotonic()
+                    # Aproveita para descartar os resumos que já expiraram.
+                    for expirada in [k for k, (expira_em, _) in cache_resumos.items() if expira_em <= agora]:
+                        del cache_resumos[expirada]
+                    cache_resumos[chave] = (agora + TTL_RESUMO_FUNCIONARIO, resumo)
+        return resumo, False
+    finally:
+        with trava_cache_resumos:
+            calculo['usuarios'] -= 1
+            if calculo['usuarios'] == 0:
+                del calculos_resumos[chave]
+
+def serializador_links_funcionarios():
+    """
+    Assina os tokens dos links pessoais dos funcionários com a SECRET_KEY do ambiente
+    (os tokens levam a data de emissão). Retorna None se a SECRET_KEY não estiver definida.
+    """
+    chave = os.environ.get('SECRET_KEY')
+    if not chave:
+        return None
+    return URLSafeTimedSerializer(chave, salt='resumo-funcionario')
+
+def token_funcionario(func_id, fazenda_id=FAZENDA_PADRAO):
+    """Token do link pessoal de um funcionário de uma fazenda (RuntimeError sem SECRET_KEY)."""
+    serializador = serializador_links_funcionarios()
+    if serializador is None:
+        raise RuntimeError("Defina a variável de ambiente SECRET_KEY para gerar links pessoais.")
+    return serializador.dumps([fazenda_id, str(func_id)])
+
+def fazenda_do_token(token, func_id):
+    """
+    Confere se o token é o do link pessoal deste funcionário e ainda está na validade.
+    Retorna a fazenda dele (None se o token não for válido ou se não há SECRET_KEY).
+    """
+    serializador = serializador_links_funcionarios()
+    if serializador is None:
+        return None
+    try:
+        conteudo = serializador.loads(token, max_age=VALIDADE_LINK_FUNCIONARIO_DIAS * 86400)
+    except BadSignature:
+        # Assinatura inválida ou link vencido (SignatureExpired é um BadSignature).
+        return None
+    if isinstance(conteudo, list) and len(conteudo) == 2 and conteudo[1] == str(func_id):
+        return conteudo[0]
+    return None
+
+@rotas.route('/api/v1/funcionarios/<func_id>/resumo')
+def resumo_funcionario(func_id):
+    """
+    Resumo do mês de um funcionário (parâmetro 'mes' no formato AAAA-MM; o padrão é o
+    mês atual). Acessível pelo administrador logado (funcionário da fazenda selecionada) ou
+    pelo link pessoal (parâmetro 'token', que traz a fazenda do funcionário).
+    O cabeçalho X-Cache indica se o resumo veio do cache (HIT) ou foi calculado (MISS).
+    """
+    token = request.args.get('token')
+    fazenda_id = fazenda_do_token(token, func_id) if token else None
+    if fazenda_id is None:
+        if not session.get('logged_in'):
+            return jsonify({'success': False, 'message': 'Não autorizado'}), 401
+        fazenda_id = id_fazenda_atual()
+    fazenda = obter_fazendas().get(fazenda_id)
+    if fazenda is None or func_id not in fazenda.funcionarios:
+        return jsonify({'success': False, 'message': 'Funcionário não encontrado'}), 404
+
+    try:
+        mes_param = request.args.get('mes') or datetime.now().strftime('%Y-%m')
+        inicio = datetime.strptime(mes_param, '%Y-%m')
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Mês inválido (use AAAA-MM)'}), 400
+
+    try:
+        resumo, do_cache = obter_resumo_funcionario(func_id, inicio.year, inicio.month, fazenda.id)
+    except Exception as e:
+        print(f"Erro ao calcular o resumo do funcionário {func_id}: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+    response = jsonify(resumo)
+    response.headers["X-Cache"] = "HIT" if do_cache else "MISS"
+    return response
+
+@click.command('link-funcionario')
+@click.argument('func_id')
+@click.option('--fazenda', 'fazenda_id', default=FAZENDA_PADRAO, help='ID da fazenda do funcionário.')
+@with_appcontext
+def comando_link_funcionario(func_id, fazenda_id):
+    """Mostra o link pessoal do resumo de um funcionário."""
+    try:
+        token = token_funcionario(func_id, fazenda_id)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    print(f"/api/v1/funcionarios/{func_id}/resumo?token={token}")
+    print(f"(válido por {VALIDADE_LINK_FUNCIONARIO_DIAS} dias)")
+
 # --- Novas Rotas para Ponto Manual e Justificativas ---
 
-@app.route('/add_manual_point', methods=['POST'])
+@rotas.route('/add_manual_point', methods=['POST'])
 def add_manual_point():
     """
-    Processa o formulário de inserção manual de ponto.
+    Processa o formulário de inserção manual de ponto (na fazenda selecionada).
     """
     if not session.get('logged_in'):
-        return redirect(url_for('login'))
+        return redirect(url_for('ponto.login'))
 
     func_id = request.form.get('func_id')
     data = request.form.get('data')
     hora = request.form.get('hora')
     justificativa = request.form.get('justificativa')
+    fazenda_id = id_fazenda_atual()
 
     try:
         # Combina data e hora e converte para datetime.
@@ -666,21 +2418,24 @@ def add_manual_point():
         conn = get_db_connection()
         cur = conn.cursor()
         # Insere o registro marcando como origem 'manual'.
-        cur.execute("INSERT INTO registros (func_id, horario, origem, justificativa) VALUES (%s, %s, %s, %s)",
-                    (func_id, horario, 'manual', justificativa))
+        cur.execute("""
+            INSERT INTO registros (fazenda_id, func_id, horario, origem, justificativa)
+            VALUES (%s, %s, %s, %s, %s)
+        """, (fazenda_id, func_id, horario, 'manual', justificativa))
         conn.commit()
+        invalidar_resumos([(func_id, horario)], fazenda_id)
         cur.close()
         conn.close()
         flash('Ponto manual adicionado com sucesso!')
     except Exception as e:
         flash(f'Erro ao adicionar ponto manual: {e}')
 
-    return redirect(url_for('index'))
+    return redirect(url_for('ponto.index'))
 
-@app.route('/update_justification', methods=['POST'])
+@rotas.route('/update_justification', methods=['POST'])
 def update_justification():
     """
-    Atualiza a justificativa de um registro de ponto existente.
+    Atualiza a justificativa de um registro de ponto existente da fazenda selecionada.
     Usado via AJAX (fetch) a partir do dashboard.
     """
     if not session.get('logged_in'):
@@ -690,19 +2445,660 @@ def update_justification():
     # Aqui vamos usar request.form para simplicidade com o formulário padrão.
     ponto_id = request.form.get('ponto_id')
     justificativa = request.form.get('justificativa')
+    fazenda_id = id_fazenda_atual()
 
     try:
         conn = get_db_connection()
         cur = conn.cursor()
-        cur.execute("UPDATE registros SET justificativa = %s WHERE id = %s", (justificativa, ponto_id))
+        # Toda edição recebe uma nova versão (ver migração 4a5b6c7d8e9f).
+        # O filtro pela fazenda impede editar batidas de outra fazenda.
+        cur.execute("""
+            UPDATE registros SET justificativa = %s, versao = nextval('registros_versao_seq'),
+                                 transacao = pg_current_xact_id()
+            WHERE id = %s AND fazenda_id = %s
+            RETURNING versao, func_id, horario
+        """, (justificativa, ponto_id, fazenda_id))
+        row = cur.fetchone()
         conn.commit()
+        if row:
+            invalidar_resumos([(row[1], row[2])], fazenda_id)
         cur.close()
         conn.close()
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'versao': row[0] if row else None})
     except Exception as e:
         print(f"Erro ao atualizar justificativa: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
+# Limite de edições aceitas em uma única chamada do lote.
+MAX_EDICOES_LOTE = 1000
+
+@rotas.route('/update_justifications', methods=['POST'])
+def update_justifications():
+    """
+    Atualiza as justificativas de vários registros de uma vez.
+    Recebe um JSON {"edicoes": [{"id": 1, "justificativa": "..."}, ...]} e aplica
+    tudo em um único comando UPDATE ... FROM (VALUES ...) dentro de uma transação.
+
+    Retorna os registros alterados (id, func_id, data) e a maior versão gravada,
+    para que resumos em cache possam ser invalidados com precisão. Só registros da
+    fazenda selecionada são alterados (os de outras fazendas voltam como não encontrados).
+    """
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'message': 'Não logado'}), 401
+
+    dados = request.get_json(silent=True) or {}
+    edicoes = dados.get('edicoes')
+    if not isinstance(edicoes, list) or not edicoes:
+        return jsonify({'success': False, 'message': 'Nenhuma edição enviada'}), 400
+    if len(edicoes) > MAX_EDICOES_LOTE:
+        return jsonify({'success': False, 'message': f'Máximo de {MAX_EDICOES_LOTE} edições por lote'}), 400
+
+    # Se o mesmo registro aparecer mais de uma vez, vale a última edição
+    # (o UPDATE ... FROM não define qual linha venceria em caso de repetição).
+    por_id = {}
+    try:
+        for edicao in edicoes:
+            por_id[int(edicao['id'])] = edicao.get('justificativa') or None
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Cada edição precisa de um "id" numérico'}), 400
+
+    # Monta a lista VALUES com parâmetros (%s), o que continua protegendo contra SQL Injection.
+    valores = ", ".join(["(%s::integer, %s::text)"] * len(por_id))
+    fazenda_id = id_fazenda_atual()
+    parametros = [p for item in por_id.items() for p in item] + [fazenda_id]
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(f"""
+            UPDATE registros AS r
+            SET justificativa = v.justificativa, versao = nextval('registros_versao_seq'),
+                transacao = pg_current_xact_id()
+            FROM (VALUES {valores}) AS v(id, justificativa)
+            WHERE r.id = v.id AND r.fazenda_id = %s
+            RETURNING r.id, r.func_id, r.horario, r.versao
+        """, parametros)
+        alterados = cur.fetchall()
+        conn.commit()
+        cur.close()
+        invalidar_resumos(((r[1], r[2]) for r in alterados), fazenda_id)
+
+        return jsonify({
+            'success': True,
+            'atualizados': [{'id': r[0], 'func_id': r[1], 'data': r[2].strftime('%Y-%m-%d')} for r in alterados],
+            'nao_encontrados': sorted(set(por_id) - {r[0] for r in alterados}),
+            'versao': max((r[3] for r in alterados), default=None),
+        })
+    except Exception as e:
+        print(f"Erro ao atualizar justificativas em lote: {e}")
+        if conn:
+            conn.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 500
+    finally:
+        if conn:
+            conn.close()
+
+# --- Página de Administração: Consultas SQL ---
+
+@rotas.route('/admin/consultas')
+def admin_consultas():
+    """Exibe os comandos SQL que mais consomem tempo e as últimas consultas lentas."""
+    if not session.get('logged_in'):
+        return redirect(url_for('ponto.login'))
+
+    with trava_estatisticas:
+        # Ordena os locais de chamada pelo tempo total gasto (os maiores "ofensores" primeiro).
+        ranking = sorted(
+            ({'local': local, 'media_ms': e['total_ms'] / e['execucoes'], **e}
+             for local, e in estatisticas_consultas.items()),
+            key=lambda e: e['total_ms'],
+            reverse=True
+        )
+        lentas = list(consultas_lentas)
+
+    return render_template('admin_consultas.html',
+                           ranking=ranking,
+                           lentas=lentas,
+                           limite_ms=LIMITE_CONSULTA_LENTA_MS)
+
+# --- Profiler de Requisições sob Demanda ---
+# Um administrador logado pode pedir o perfil de uma requisição adicionando '?profile=1'
+# na URL ou o cabeçalho 'X-Profile: 1'. Enquanto a requisição roda, uma thread separada
+# tira "fotos" da pilha de chamadas da thread da requisição em intervalos fixos
+# (profiler por amostragem). Sem o pedido, nada é iniciado: o custo é só um 'if'.
+# Os últimos perfis ficam na memória do processo e podem ser vistos em /admin/perfis.
+
+# Intervalo entre as amostras da pilha, em segundos.
+INTERVALO_AMOSTRAGEM_PERFIL = 0.002
+# Quantidade de perfis guardados (os mais antigos são descartados).
+perfis_requisicoes = deque(maxlen=20)
+trava_perfis = threading.Lock()
+proximo_id_perfil = 1
+
+class AmostradorPilha:
+    """Amostra periodicamente a pilha de chamadas de uma thread."""
+
+    def __init__(self, thread_id, intervalo=INTERVALO_AMOSTRAGEM_PERFIL):
+        self.thread_id = thread_id
+        self.intervalo = intervalo
+        # Conta quantas vezes cada pilha (da raiz até a função em execução) foi vista.
+        self.pilhas = Counter()
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._rodar, daemon=True)
+
+    def iniciar(self):
+        self.inicio = perf_counter()
+        self._thread.start()
+
+    def parar(self):
+        self._parar.set()
+        self._thread.join()
+        self.duracao_ms = (perf_counter() - self.inicio) * 1000
+
+    def _rodar(self):
+        while not self._parar.wait(self.intervalo):
+            frame = sys._current_frames().get(self.thread_id)
+            pilha = []
+            while frame is not None:
+                codigo = frame.f_code
+                pilha.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+                frame = frame.f_back
+            if pilha:
+                self.pilhas[tuple(reversed(pilha))] += 1
+
+def perfil_solicitado():
+    """Verifica se a requisição atual pediu o profiler (somente para usuários logados)."""
+    pedido = request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'
+    return pedido and session.get('logged_in')
+
+def iniciar_perfil():
+    """Executado antes de cada requisição: inicia o amostrador se o perfil foi pedido."""
+    if perfil_solicitado():
+        g.amostrador = AmostradorPilha(threading.get_ident())
+        g.amostrador.iniciar()
+
+def finalizar_perfil(response):
+    """Executado depois de cada requisição: para o amostrador e guarda o perfil."""
+    global proximo_id_perfil
+    amostrador = g.pop('amostrador', None)
+    if amostrador is None:
+        return response
+
+    amostrador.parar()
+    with trava_perfis:
+        perfil_id = proximo_id_perfil
+        proximo_id_perfil += 1
+        perfis_requisicoes.appendleft({
+            'id': perfil_id,
+            'metodo': request.method,
+            'caminho': request.full_path.rstrip('?'),
+            'status': response.status_code,
+            'quando': datetime.now(),
+            'duracao_ms': amostrador.duracao_ms,
+            'amostras': sum(amostrador.pilhas.values()),
+            'intervalo_ms': amostrador.intervalo * 1000,
+            'pilhas': amostrador.pilhas,
+        })
+    response.headers['X-Profile-Id'] = str(perfil_id)
+    return response
+
+def descartar_perfil(exc):
+    """Executado ao fim de toda requisição: garante que o amostrador pare mesmo se houve erro."""
+    amostrador = g.pop('amostrador', None)
+    if amostrador is not None:
+        amostrador.parar()
+
+def buscar_perfil(perfil_id):
+    """Retorna o perfil guardado com o id informado (ou None)."""
+    with trava_perfis:
+        return next((p for p in perfis_requisicoes if p['id'] == perfil_id), None)
+
+def perfil_para_speedscope(perfil):
+    """Converte um perfil para o formato de arquivo do speedscope (https://www.speedscope.app)."""
+    frames = []
+    indice_frames = {}
+    amostras = []
+    pesos = []
+    for pilha, quantidade in perfil['pilhas'].items():
+        amostra = []
+        for nome in pilha:
+            if nome not in indice_frames:
+                indice_frames[nome] = len(frames)
+                frames.append({'name': nome})
+            amostra.append(indice_frames[nome])
+        amostras.append(amostra)
+        pesos.append(quantidade * perfil['intervalo_ms'])
+
+    nome = f"{perfil['metodo']} {perfil['caminho']}"
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': nome,
+        'exporter': 'ponto-fazenda',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': nome,
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': sum(pesos),
+            'samples': amostras,
+            'weights': pesos,
+        }],
+    }
+
+def perfil_para_folded(perfil):
+    """Converte um perfil para o formato "folded" do flamegraph.pl (uma pilha por linha)."""
+    return "\n".join(f"{';'.join(pilha)} {quantidade}" for pilha, quantidade in perfil['pilhas'].items()) + "\n"
+
+@rotas.route('/admin/perfis')
+def admin_perfis():
+    """Lista os últimos perfis de requisições capturados."""
+    if not session.get('logged_in'):
+        return redirect(url_for('ponto.login'))
+    with trava_perfis:
+        perfis = list(perfis_requisicoes)
+    return render_template('admin_perfis.html', perfis=perfis)
+
+@rotas.route('/admin/perfis/<int:perfil_id>/<formato>')
+def exportar_perfil(perfil_id, formato):
+    """Baixa um perfil no formato do speedscope ('speedscope') ou do flamegraph ('folded')."""
+    if not session.get('logged_in'):
+        return redirect(url_for('ponto.login'))
+    perfil = buscar_perfil(perfil_id)
+    if perfil is None:
+        return "Perfil não encontrado", 404
+
+    if formato == 'speedscope':
+        response = make_response(json.dumps(perfil_para_speedscope(perfil)))
+        response.headers["Content-type"] = "application/json"
+        response.headers["Content-Disposition"] = f"attachment; filename=perfil_{perfil_id}.speedscope.json"
+    elif formato == 'folded':
+        response = make_response(perfil_para_folded(perfil))
+        response.headers["Content-type"] = "text/plain; charset=utf-8"
+        response.headers["Content-Disposition"] = f"attachment; filename=perfil_{perfil_id}.folded"
+    else:
+        return "Formato desconhecido", 404
+    return response
+
+# --- Importação em Lote de Pontos Manuais (CSV/XLSX) ---
+
+# Colunas obrigatórias da planilha de importação.
+COLUNAS_IMPORTACAO = ['func_id', 'data', 'hora', 'justificativa']
+
+def ler_planilha_pontos(conteudo, nome_arquivo):
+    """
+    Lê o arquivo enviado (CSV ou XLSX) para um DataFrame com todas as colunas como texto.
+
+    Args:
+        conteudo (bytes): O conteúdo bruto do arquivo.
+        nome_arquivo (str): O nome original do arquivo, usado para detectar o formato.
+    """
+    import pandas as pd
+
+    if nome_arquivo.lower().endswith(('.xlsx', '.xls')):
+        df = pd.read_excel(BytesIO(conteudo), dtype=str)
+    else:
+        # sep=None faz o pandas detectar o separador (vírgula ou ponto e vírgula).
+        df = pd.read_csv(BytesIO(conteudo), dtype=str, sep=None, engine='python', encoding='utf-8-sig')
+    # Normaliza os nomes das colunas (ex: " Func_ID " -> "func_id").
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    return df
+
+def validar_pontos_importados(df, funcionarios_map):
+    """
+    Valida todas as linhas da planilha de uma só vez (operações vetorizadas do pandas).
+
+    Returns:
+        tuple: (validos, erros), onde 'validos' é um DataFrame com as colunas
+               linha, func_id, horario e justificativa, e 'erros' é uma lista de
+               dicionários {'linha': n, 'erro': mensagem}. O número da linha segue
+               a planilha (a linha 1 é o cabeçalho).
+    """
+    import pandas as pd
+
+    faltando = [c for c in COLUNAS_IMPORTACAO if c not in df.columns]
+    if faltando:
+        return df.iloc[0:0], [{'linha': 1, 'erro': f"Colunas ausentes: {', '.join(faltando)}"}]
+
+    df = df[COLUNAS_IMPORTACAO].fillna('').apply(lambda col: col.str.strip())
+    df.insert(0, 'linha', df.index + 2)
+
+    # Datas podem vir como '2024-05-20' (CSV) ou '2024-05-20 00:00:00' (células de data do Excel).
+    datas = pd.to_datetime(df['data'].str.slice(0, 10), format='%Y-%m-%d', errors='coerce')
+    # Horas podem vir como '7:00', '07:00' ou '07:00:00' (células de hora do Excel). Só esses
+    # formatos são aceitos: valores como '-1:00', '25:00' ou '1 day' seriam timedeltas válidos
+    # para o pandas, mas não são horas do dia.
+    partes = df['hora'].str.extract(r'^(\d{1,2}):(\d{2})(?::(\d{2}))?$').astype(float)
+    hora, minuto, segundo = partes[0], partes[1], partes[2].fillna(0)
+    hora_do_dia = (hora < 24) & (minuto < 60) & (segundo < 60)
+    horas = pd.to_timedelta(hora * 3600 + minuto * 60 + segundo, unit='s').where(hora_do_dia)
+    df['horario'] = datas + horas
+
+    # Cada regra gera uma máscara booleana; a primeira regra violada é a reportada.
+    regras = [
+        (~df['func_id'].isin(list(funcionarios_map.keys())), 'Funcionário desconhecido'),
+        (datas.isna(), 'Data inválida (use AAAA-MM-DD)'),
+        (horas.isna(), 'Hora inválida (use HH:MM)'),
+        (df['justificativa'] == '', 'Justificativa obrigatória'),
+        (df.duplicated(['func_id', 'horario'], keep='first') & df['horario'].notna(), 'Linha duplicada na planilha'),
+    ]
+    mensagens = pd.Series('', index=df.index)
+    for mascara, mensagem in reversed(regras):
+        mensagens = mensagens.mask(mascara, mensagem)
+
+    com_erro = mensagens != ''
+    erros = [{'linha': int(linha), 'erro': erro}
+             for linha, erro in zip(df.loc[com_erro, 'linha'], mensagens[com_erro])]
+    validos = df.loc[~com_erro, ['linha', 'func_id', 'horario', 'justificativa']]
+    return validos, erros
+
+def buscar_pontos_existentes(cur, validos, fazenda_id=FAZENDA_PADRAO):
+    """Retorna o conjunto de (func_id, horario) da planilha que já existem no banco (na fazenda)."""
+    if validos.empty:
+        return set()
+    cur.execute("""
+        SELECT func_id, horario FROM registros
+        WHERE fazenda_id = %s AND func_id = ANY(%s) AND horario BETWEEN %s AND %s
+    """, (fazenda_id, sorted(validos['func_id'].unique().tolist()),
+          validos['horario'].min().to_pydatetime(), validos['horario'].max().to_pydatetime()))
+    return set(cur.fetchall())
+
+@rotas.route('/import_manual_points', methods=['POST'])
+def import_manual_points():
+    """
+    Importa vários pontos manuais de uma vez (na fazenda selecionada) a partir de um
+    arquivo CSV/XLSX com as colunas func_id, data, hora e justificativa.
+
+    Com 'dry_run' marcado, apenas devolve o que seria inserido (o "diff"), sem gravar.
+    Caso contrário, grava tudo em uma única transação usando COPY. Se qualquer linha
+    tiver erro, nada é gravado e os erros são devolvidos linha a linha.
+    """
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'message': 'Não logado'}), 401
+
+    arquivo = request.files.get('arquivo')
+    if not arquivo or not arquivo.filename:
+        return jsonify({'success': False, 'message': 'Nenhum arquivo enviado'}), 400
+    dry_run = request.form.get('dry_run') in ('1', 'true', 'on')
+
+    try:
+        df = ler_planilha_pontos(arquivo.read(), arquivo.filename)
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Não foi possível ler o arquivo: {e}'}), 400
+
+    fazenda = fazenda_atual()
+    validos, erros = validar_pontos_importados(df, fazenda.funcionarios)
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+
+        # Pontos que já estão no banco são ignorados (permite reenviar a mesma planilha).
+        existentes = buscar_pontos_existentes(cur, validos, fazenda.id)
+        ja_existe = [(f, h.to_pydatetime()) in existentes for f, h in zip(validos['func_id'], validos['horario'])]
+        duplicados = validos[ja_existe]
+        novos = validos[[not x for x in ja_existe]]
+
+        resultado = {
+            'success': not erros,
+            'dry_run': dry_run,
+            'erros': erros,
+            'novos': [{'linha': int(r.linha), 'funcionario': fazenda.funcionarios.get(r.func_id, 'Desconhecido'),
+                       'horario': r.horario.strftime('%d/%m/%Y %H:%M'), 'justificativa': r.justificativa}
+                      for r in novos.itertuples()],
+            'duplicados': [int(linha) for linha in duplicados['linha']],
+            'inseridos': 0,
+        }
+
+        if not dry_run and not erros and not novos.empty:
+            # Monta um CSV em memória e envia tudo ao banco com um único COPY.
+            buffer = BytesIO()
+            novos.assign(fazenda_id=fazenda.id, origem='manual')[
+                ['fazenda_id', 'func_id', 'horario', 'origem', 'justificativa']].to_csv(
+                buffer, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S')
+            buffer.seek(0)
+            cur.copy_expert(
+                "COPY registros (fazenda_id, func_id, horario, origem, justificativa) FROM STDIN WITH (FORMAT csv)",
+                buffer)
+            conn.commit()
+            invalidar_resumos(zip(novos['func_id'], novos['horario']), fazenda.id)
+            resultado['inseridos'] = len(novos)
+
+        cur.close()
+        return jsonify(resultado), (200 if not erros else 400)
+    except Exception as e:
+        print(f"Erro ao importar pontos manuais: {e}")
+        if conn:
+            conn.rollback()
+        return jsonify({'success': False, 'message': str(e), 'erros': erros}), 500
+    finally:
+        if conn:
+            conn.close()
+
+# --- Retenção e Compactação das Imagens de access_logs ---
+# A coluna access_logs.image_base64 guarda a foto de cada evento e faz a tabela crescer
+# muito. O job abaixo move as imagens antigas para arquivos em disco, endereçados pelo
+# conteúdo (o nome do arquivo é o SHA-256 da imagem, então imagens iguais são gravadas
+# uma vez só), comprimidos com gzip. No banco, image_base64 vira NULL e image_ref guarda o hash.
+# Nas fotos JPEG (a maioria) o gzip quase não reduz o tamanho, mas é mantido: os arquivos já
+# arquivados estão nesse formato, as imagens em formatos sem compressão (BMP) encolhem bastante,
+# e o CRC do gzip faz um arquivo truncado ou corrompido dar erro na leitura em vez de virar uma
+# imagem quebrada. O nome .jpg.gz vem da primeira versão; o tipo real é detectado ao servir.
+# O trabalho é feito em lotes pequenos, cada um na sua própria transação curta, para não
+# segurar travas por muito tempo.
+
+# Diretório onde as imagens arquivadas são gravadas.
+DIRETORIO_IMAGENS = os.environ.get('IMAGE_ARCHIVE_DIR', 'arquivo_imagens')
+# Idade (em dias) a partir da qual as imagens são arquivadas.
+IDADE_IMAGENS_DIAS = int(os.environ.get('IMAGE_RETENTION_DAYS', '90'))
+# Quantidade de linhas processadas por transação.
+TAMANHO_LOTE_IMAGENS = 200
+
+def caminho_imagem_arquivada(referencia, diretorio=None):
+    """Caminho do arquivo de uma imagem (ex: arquivo_imagens/ab/cd/abcd....jpg.gz)."""
+    return os.path.join(diretorio or DIRETORIO_IMAGENS, referencia[:2], referencia[2:4], f"{referencia}.jpg.gz")
+
+def arquivar_imagem(imagem, diretorio=None):
+    """
+    Grava a imagem (bytes) no arquivo endereçado pelo conteúdo e retorna a referência (hash).
+    Se o arquivo já existe, nada é gravado de novo.
+    """
+    referencia = hashlib.sha256(imagem).hexdigest()
+    caminho = caminho_imagem_arquivada(referencia, diretorio)
+    if not os.path.exists(caminho):
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        # Grava em um arquivo temporário e renomeia: um arquivo pela metade nunca fica com o nome final.
+        temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporario, 'wb') as f:
+            f.write(gzip.compress(imagem))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporario, caminho)
+    return referencia
+
+# Assinaturas (primeiros bytes) dos formatos de imagem que os equipamentos podem enviar.
+ASSINATURAS_IMAGEM = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+]
+
+def tipo_da_imagem(imagem):
+    """Detecta o tipo (MIME) da imagem pelos primeiros bytes; desconhecido vira application/octet-stream."""
+    if imagem[:4] == b'RIFF' and imagem[8:12] == b'WEBP':
+        return 'image/webp'
+    for assinatura, tipo in ASSINATURAS_IMAGEM:
+        if imagem.startswith(assinatura):
+            return tipo
+    return 'application/octet-stream'
+
+def ler_imagem_arquivada(referencia, diretorio=None):
+    """Lê (e descomprime) uma imagem arquivada a partir da sua referência."""
+    with open(caminho_imagem_arquivada(referencia, diretorio), 'rb') as f:
+        return gzip.decompress(f.read())
+
+def compactar_imagens_access_logs(idade_dias=None, tamanho_lote=TAMANHO_LOTE_IMAGENS, max_lotes=None,
+                                  diretorio=None, pausa=0.0):
+    """
+    Arquiva as imagens dos access_logs mais antigas que 'idade_dias'.
+
+    Args:
+        idade_dias (int): Imagens de eventos mais antigos que isso são arquivadas.
+        tamanho_lote (int): Linhas por transação.
+        max_lotes (int | None): Limite de lotes nesta execução (None = até acabar).
+        diretorio (str | None): Diretório do arquivo de imagens.
+        pausa (float): Segundos de espera entre os lotes, para aliviar o banco.
+
+    Returns:
+        dict: {'arquivadas': n, 'invalidas': n, 'lotes': n}
+    """
+    limite = datetime.now() - timedelta(days=idade_dias if idade_dias is not None else IDADE_IMAGENS_DIAS)
+    estatisticas = {'arquivadas': 0, 'invalidas': 0, 'lotes': 0}
+    # Paginação pelo id: linhas com imagem inválida ficam para trás e não são relidas.
+    ultimo_id = 0
+
+    conn = get_db_connection()
+    try:
+        while max_lotes is None or estatisticas['lotes'] < max_lotes:
+            cur = conn.cursor()
+            # SKIP LOCKED: se outra execução do job estiver no mesmo lote, pula essas linhas.
+            cur.execute("""
+                SELECT id, image_base64 FROM access_logs
+                WHERE image_base64 IS NOT NULL AND event_time < %s AND id > %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (limite, ultimo_id, tamanho_lote))
+            linhas = cur.fetchall()
+            if not linhas:
+                cur.close()
+                conn.commit()
+                break
+
+            referencias = []
+            for log_id, imagem_base64 in linhas:
+                try:
+                    imagem = base64.b64decode(imagem_base64, validate=True)
+                except Exception:
+                    print(f"Imagem inválida no access_log {log_id}; mantida no banco.")
+                    estatisticas['invalidas'] += 1
+                    continue
+                referencias.append((log_id, arquivar_imagem(imagem, diretorio)))
+
+            if referencias:
+                valores = ", ".join(["(%s::integer, %s::varchar)"] * len(referencias))
+                cur.execute(f"""
+                    UPDATE access_logs AS a SET image_base64 = NULL, image_ref = v.ref
+                    FROM (VALUES {valores}) AS v(id, ref)
+                    WHERE a.id = v.id
+                """, [p for item in referencias for p in item])
+            conn.commit()
+            cur.close()
+
+            estatisticas['arquivadas'] += len(referencias)
+            estatisticas['lotes'] += 1
+            ultimo_id = linhas[-1][0]
+            if pausa:
+                sleep(pausa)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    print(f"Compactação de imagens concluída: {estatisticas}")
+    return estatisticas
+
+@rotas.route('/access_logs/<int:log_id>/imagem')
+def imagem_access_log(log_id):
+    """Retorna a imagem de um evento, esteja ela ainda no banco ou já arquivada em disco."""
+    if not session.get('logged_in'):
+        return redirect(url_for('ponto.login'))
+
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT image_base64, image_ref FROM access_logs WHERE id = %s", (log_id,))
+        row = cur.fetchone()
+        cur.close()
+        conn.close()
+
+        if row and row[0]:
+            imagem = base64.b64decode(row[0])
+        elif row and row[1]:
+            imagem = ler_imagem_arquivada(row[1])
+        else:
+            return "Imagem não encontrada", 404
+    except Exception as e:
+        return f"Erro ao buscar imagem: {e}", 500
+
+    response = make_response(imagem)
+    # O tipo vem do conteúdo: nem todo equipamento envia JPEG.
+    response.headers["Content-type"] = tipo_da_imagem(imagem)
+    # As imagens nunca mudam, então o navegador pode guardá-las em cache.
+    response.headers["Cache-Control"] = "private, max-age=86400"
+    return response
+
+@click.command('compactar-imagens')
+@click.option('--dias', default=IDADE_IMAGENS_DIAS, help='Idade mínima das imagens, em dias.')
+@click.option('--lote', default=TAMANHO_LOTE_IMAGENS, help='Linhas por transação.')
+@click.option('--max-lotes', default=None, type=int, help='Limite de lotes nesta execução.')
+@click.option('--pausa', default=0.0, help='Segundos de espera entre os lotes.')
+def comando_compactar_imagens(dias, lote, max_lotes, pausa):
+    """Arquiva as imagens antigas da tabela access_logs."""
+    compactar_imagens_access_logs(idade_dias=dias, tamanho_lote=lote, max_lotes=max_lotes, pausa=pausa)
+
+# --- Fábrica do Aplicativo Flask ---
+
+def create_app():
+    """
+    Cria e configura uma instância do aplicativo Flask.
+    Não faz nenhum acesso à rede ou ao banco de dados: só registra as rotas.
+    """
+    # Cria a instância principal do nosso aplicativo web.
+    app = Flask(__name__)
+    # Define uma "chave secreta" que o Flask usa para proteger as sessões dos usuários.
+    # É importante que seja um valor longo, aleatório e secreto em um ambiente de produção.
+    # Em produção defina SECRET_KEY no ambiente; o valor abaixo só serve para desenvolvimento
+    # (e, sem SECRET_KEY, os links pessoais dos funcionários ficam desativados).
+    app.secret_key = os.environ.get('SECRET_KEY') or 'sua_senha_super_secreta_aqui'
+
+    # Registra as rotas HTTP e WebSocket anotadas no Blueprint.
+    app.register_blueprint(rotas)
+
+    # Profiler sob demanda (só é ativado quando a requisição pede).
+    app.before_request(iniciar_perfil)
+    app.after_request(finalizar_perfil)
+    app.teardown_request(descartar_perfil)
+
+    # Comando de linha de comando para o job de compactação (pode ser agendado no cron):
+    #   flask --app app compactar-imagens --dias 90
+    app.cli.add_command(comando_compactar_imagens)
+    # Exportação Parquet para um diretório: flask --app app exportar-parquet /dados/ponto --incremental
+    app.cli.add_command(comando_exportar_parquet)
+    # Comparação dos motores de relatórios: flask --app app validar-motor-sql --inicio 2024-01-01
+    app.cli.add_command(comando_validar_motor_sql)
+    # Link pessoal do resumo de um funcionário: flask --app app link-funcionario 1 --fazenda 1
+    app.cli.add_command(comando_link_funcionario)
+    # Cadastro das fazendas: flask --app app criar-fazenda "Fazenda Boa Vista" 3170206
+    app.cli.add_command(comando_criar_fazenda)
+    # Funcionários de uma fazenda: flask --app app cadastrar-funcionario 2 15 "José"
+    app.cli.add_command(comando_cadastrar_funcionario)
+    # Equipamento de uma fazenda: flask --app app vincular-dispositivo SN123 2
+    app.cli.add_command(comando_vincular_dispositivo)
+
+    # Inicializa o Flask-Sock para adicionar suporte a WebSockets ao aplicativo.
+    sock.init_app(app)
+
+    return app
+
+# Instância usada pela Vercel e pelo gunicorn (`gunicorn app:app`).
+app = create_app()
+
 # --- Ponto de Entrada para Execução do Servidor ---
 # Este bloco só é executado quando o script é rodado diretamente (ex: `python app.py`).
 if __name__ == '__main__':
@@ -0,0 +1,32 @@
+"""Add versao to registros
+
+Revision ID: 4a5b6c7d8e9f
+Revises: 3a4b5c6d7e8f
+Create Date: 2024-06-03 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# Identificadores da revisão
+revision = '4a5b6c7d8e9f'
+down_revision = '3a4b5c6d7e8f'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # 1. Sequência global de versões: toda inserção ou edição em registros recebe um número novo.
+    #    Assim quem guarda dados em cache sabe exatamente o que mudou desde a última leitura.
+    op.execute("CREATE SEQUENCE IF NOT EXISTS registros_versao_seq")
+
+    # 2. Coluna de versão (registros existentes recebem uma versão cada um pelo default).
+    op.add_column('registros', sa.Column('versao', sa.BigInteger(),
+                                         server_default=sa.text("nextval('registros_versao_seq')"),
+                                         nullable=False))
+    op.create_index('idx_registros_versao', 'registros', ['versao'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_registros_versao', table_name='registros')
+    op.drop_column('registros', 'versao')
+    op.execute("DROP SEQUENCE IF EXISTS registros_versao_seq")
@@ -0,0 +1,27 @@
+"""Add sync cursor to dispositivos
+
+Revision ID: 5a6b7c8d9e0f
+Revises: 4a5b6c7d8e9f
+Create Date: 2024-06-10 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# Identificadores da revisão
+revision = '5a6b7c8d9e0f'
+down_revision = '4a5b6c7d8e9f'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Último 'logindex' gravado sem lacunas para cada dispositivo (cursor de sincronização).
+    # Nulo enquanto o dispositivo ainda não enviou nenhum log com logindex.
+    op.add_column('dispositivos', sa.Column('last_logindex', sa.BigInteger(), nullable=True))
+    # Momento em que o cursor avançou pela última vez.
+    op.add_column('dispositivos', sa.Column('last_sync', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('dispositivos', 'last_sync')
+    op.drop_column('dispositivos', 'last_logindex')
@@ -0,0 +1,29 @@
+"""Add image_ref to access_logs
+
+Revision ID: 6a7b8c9d0e1f
+Revises: 5a6b7c8d9e0f
+Create Date: 2024-06-17 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# Identificadores da revisão
+revision = '6a7b8c9d0e1f'
+down_revision = '5a6b7c8d9e0f'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # 1. Referência (hash SHA-256) da imagem arquivada em disco, quando image_base64 foi compactada.
+    op.add_column('access_logs', sa.Column('image_ref', sa.String(length=64), nullable=True))
+
+    # 2. Índice parcial só com as linhas que ainda têm imagem no banco:
+    #    o job de compactação encontra os lotes sem varrer a tabela inteira.
+    op.create_index('idx_access_logs_com_imagem', 'access_logs', ['id'], unique=False,
+                    postgresql_where=sa.text('image_base64 IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('idx_access_logs_com_imagem', table_name='access_logs')
+    op.drop_column('access_logs', 'image_ref')
@@ -0,0 +1,23 @@
+"""Add horario index to registros
+
+Revision ID: 7a8b9c0d1e2f
+Revises: 6a7b8c9d0e1f
+Create Date: 2024-06-24 10:00:00.000000
+
+"""
+from alembic import op
+
+# Identificadores da revisão
+revision = '7a8b9c0d1e2f'
+down_revision = '6a7b8c9d0e1f'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Índice usado pelos relatórios de um período (motor SQL, espelhos, exportação Parquet):
+    # o filtro "horario >= inicio AND horario < fim" e o MIN/MAX(horario) viram leituras do índice.
+    op.create_index('idx_registros_horario', 'registros', ['horario'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_registros_horario', table_name='registros')
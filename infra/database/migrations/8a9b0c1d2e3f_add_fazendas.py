@@ -0,0 +1,64 @@
+"""Add fazendas and scope registros by fazenda
+
+Revision ID: 8a9b0c1d2e3f
+Revises: 7a8b9c0d1e2f
+Create Date: 2024-07-01 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# Identificadores da revisão
+revision = '8a9b0c1d2e3f'
+down_revision = '7a8b9c0d1e2f'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # 1. Cadastro das fazendas. O código IBGE do município define os feriados municipais.
+    #    A fazenda 1 recebe todos os dados que já existiam (instalação de uma fazenda só).
+    op.create_table(
+        'fazendas',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('nome', sa.Text(), nullable=False),
+        sa.Column('ibge_code', sa.String(length=7), nullable=False),
+    )
+    op.execute("INSERT INTO fazendas (id, nome, ibge_code) VALUES (1, 'Fazenda Ribeirão Preto', '3149800')")
+    op.execute("SELECT setval(pg_get_serial_sequence('fazendas', 'id'), 1)")
+
+    # 2. Funcionários de cada fazenda. O func_id é o número cadastrado no relógio, que só é
+    #    único dentro da fazenda (o "1" de uma fazenda não é o "1" de outra).
+    op.create_table(
+        'funcionarios',
+        sa.Column('fazenda_id', sa.Integer(), sa.ForeignKey('fazendas.id'), primary_key=True),
+        sa.Column('func_id', sa.Text(), primary_key=True),
+        sa.Column('nome', sa.Text(), nullable=False),
+    )
+    op.execute("INSERT INTO funcionarios (fazenda_id, func_id, nome) VALUES (1, '1', 'João'), (1, '2', 'Maria')")
+
+    # 3. Cada equipamento pertence a uma fazenda (NULL = ainda não vinculado; usa a fazenda padrão).
+    op.add_column('dispositivos', sa.Column('fazenda_id', sa.Integer(), sa.ForeignKey('fazendas.id'),
+                                            nullable=True))
+
+    # 4. Toda batida carrega a fazenda. Depois de preencher as linhas existentes o default é
+    #    removido: quem grava em registros precisa dizer de qual fazenda é a batida.
+    op.add_column('registros', sa.Column('fazenda_id', sa.Integer(), sa.ForeignKey('fazendas.id'),
+                                         server_default='1', nullable=False))
+    op.alter_column('registros', 'fazenda_id', server_default=None)
+
+    # 5. Índices por fazenda: o dashboard, os relatórios de um período e a exportação
+    #    incremental de uma fazenda leem só as batidas dela, não importa quantas fazendas existam.
+    #    O índice só por horario deixa de ser usado (toda consulta de período filtra a fazenda).
+    op.create_index('idx_registros_fazenda_horario', 'registros', ['fazenda_id', 'horario'], unique=False)
+    op.create_index('idx_registros_fazenda_versao', 'registros', ['fazenda_id', 'versao'], unique=False)
+    op.drop_index('idx_registros_horario', table_name='registros')
+
+
+def downgrade():
+    op.create_index('idx_registros_horario', 'registros', ['horario'], unique=False)
+    op.drop_index('idx_registros_fazenda_versao', table_name='registros')
+    op.drop_index('idx_registros_fazenda_horario', table_name='registros')
+    op.drop_column('registros', 'fazenda_id')
+    op.drop_column('dispositivos', 'fazenda_id')
+    op.drop_table('funcionarios')
+    op.drop_table('fazendas')
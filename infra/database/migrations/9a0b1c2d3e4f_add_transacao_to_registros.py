@@ -0,0 +1,67 @@
+"""Add transacao (xid8) to registros for snapshot-safe incremental cursors
+
+Revision ID: 9a0b1c2d3e4f
+Revises: 8a9b0c1d2e3f
+Create Date: 2024-07-08 09:00:00.000000
+
+"""
+from alembic import op
+
+# Identificadores da revisão
+revision = '9a0b1c2d3e4f'
+down_revision = '8a9b0c1d2e3f'
+branch_labels = None
+depends_on = None
+
+# Linhas preenchidas por transação no backfill.
+TAMANHO_LOTE = 5000
+
+def upgrade():
+    # 1. Transação (xid8, PostgreSQL 13+) que gravou a linha pela última vez. As inserções usam o
+    #    default; as edições gravam pg_current_xact_id() junto com a nova versao.
+    #    Diferente da versao, que é distribuída antes do COMMIT (e por isso pode aparecer fora de
+    #    ordem), a transação permite um cursor seguro: toda transação com id menor que
+    #    pg_snapshot_xmin(pg_current_snapshot()) já terminou, então nada abaixo dele aparece depois.
+    #
+    #    Um default volátil no ADD COLUMN reescreveria a tabela inteira sob ACCESS EXCLUSIVE
+    #    (travando as batidas durante toda a migração). Por isso a coluna entra nula e sem
+    #    default, e o default é definido num passo à parte: só vale para as linhas novas, sem
+    #    reescrever nada, e garante que nenhuma batida nova fique nula durante o backfill.
+    op.execute("ALTER TABLE registros ADD COLUMN transacao xid8")
+    op.execute("ALTER TABLE registros ALTER COLUMN transacao SET DEFAULT pg_current_xact_id()")
+
+    # Os passos abaixo rodam fora da transação da migração: cada lote faz COMMIT e segura
+    # as travas das suas linhas só por um instante.
+    with op.get_context().autocommit_block():
+        conexao = op.get_bind()
+
+        # 2. Backfill das linhas existentes, em lotes pela chave primária. Cada linha recebe a
+        #    transação do seu lote (o próximo cursor incremental a relê uma vez).
+        inicio, fim = conexao.exec_driver_sql("SELECT MIN(id), MAX(id) FROM registros").fetchone()
+        if inicio is not None:
+            for limite in range(inicio - 1, fim, TAMANHO_LOTE):
+                conexao.exec_driver_sql(
+                    "UPDATE registros SET transacao = pg_current_xact_id() "
+                    "WHERE id > %s AND id <= %s AND transacao IS NULL",
+                    (limite, limite + TAMANHO_LOTE))
+
+        # 3. NOT NULL sem varrer a tabela sob ACCESS EXCLUSIVE: a CHECK é validada com uma trava
+        #    que não bloqueia as escritas, e o SET NOT NULL (PostgreSQL 12+) aproveita a CHECK válida.
+        conexao.exec_driver_sql("ALTER TABLE registros ADD CONSTRAINT registros_transacao_not_null "
+                                "CHECK (transacao IS NOT NULL) NOT VALID")
+        conexao.exec_driver_sql("ALTER TABLE registros VALIDATE CONSTRAINT registros_transacao_not_null")
+        conexao.exec_driver_sql("ALTER TABLE registros ALTER COLUMN transacao SET NOT NULL")
+        conexao.exec_driver_sql("ALTER TABLE registros DROP CONSTRAINT registros_transacao_not_null")
+
+        # 4. Índice dos cursores incrementais (exportação Parquet e janela de batidas recentes),
+        #    por fazenda, criado sem bloquear as escritas. O índice por versao, que esses
+        #    cursores usavam, deixa de ser usado.
+        op.create_index('idx_registros_fazenda_transacao', 'registros', ['fazenda_id', 'transacao'],
+                        unique=False, postgresql_concurrently=True)
+    op.drop_index('idx_registros_fazenda_versao', table_name='registros')
+
+
+def downgrade():
+    op.create_index('idx_registros_fazenda_versao', 'registros', ['fazenda_id', 'versao'], unique=False)
+    op.drop_index('idx_registros_fazenda_transacao', table_name='registros')
+    op.drop_column('registros', 'transacao')
@@ -0,0 +1,24 @@
+"""Add last_log_time to dispositivos
+
+Revision ID: a0b1c2d3e4f5
+Revises: 9a0b1c2d3e4f
+Create Date: 2024-07-15 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# Identificadores da revisão
+revision = 'a0b1c2d3e4f5'
+down_revision = '9a0b1c2d3e4f'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Horário (no relógio do equipamento) do registro em last_logindex. Serve para reconhecer
+    # que o índice do equipamento recomeçou sem comparar o relógio dele com o do servidor.
+    op.add_column('dispositivos', sa.Column('last_log_time', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('dispositivos', 'last_log_time')
@@ -35,8 +35,9 @@ class TestDeviceStatus(unittest.TestCase):
         mock_cur.close.assert_called_once()
         mock_conn.close.assert_called_once()
 
+    @patch('app.obter_fazendas', return_value=app.fazendas_sem_banco())
     @patch('app.get_db_connection')
-    def test_index_last_comm_retrieval(self, mock_get_db):
+    def test_index_last_comm_retrieval(self, mock_get_db, _fazendas):
         mock_conn = MagicMock()
         mock_cur = MagicMock()
         mock_get_db.return_value = mock_conn